@@ -2,8 +2,8 @@
 # this repository contains the full copyright notices and license terms.
 from trytond.pool import Pool
 
-from . import (account, account_stock_eu, country, invoice, purchase, sale,
-    stock, company)
+from . import (account, account_stock_eu, country, customs, incoterm,
+    invoice, party, product, purchase, sale, stock, company)
 
 
 def register():
@@ -11,21 +11,36 @@ def register():
         country.Country,
         stock.Configuration,
         stock.StockConfigurationAccountTax,
+        stock.Location,
         stock.Move,
         stock.ShipmentIn,
         stock.ShipmentOut,
         stock.ShipmentInReturn,
         stock.ShipmentOutReturn,
         stock.ShipmentInternal,
+        account_stock_eu.IntrastatDeclaration,
+        account_stock_eu.IntrastatTransport,
+        account_stock_eu.IntrastatUpdateCheckpoint,
+        account_stock_eu.IntrastatUpdateCheckpointDeclaration,
+        account_stock_eu.IntrastatUpdateTask,
         account_stock_eu.IntrastatUpdateStart,
+        account_stock_eu.IntrastatUpdateResult,
         account.FiscalYear,
         company.Company,
         invoice.Configuration,
         invoice.ConfigurationIntrastat,
         invoice.Invoice,
+        invoice.InvoiceLine,
+        customs.ProductTariffCode,
+        product.Product,
+        product.ProductCostPrice,
+        incoterm.Incoterm,
+        party.Incoterm,
+        party.Address,
         module='account_stock_eu_es', type_='model')
     Pool.register(
         account_stock_eu.IntrastatUpdate,
+        account_stock_eu.IntrastatDeclarationExport,
         module='account_stock_eu_es', type_='wizard')
     Pool.register(
         purchase.PurchaseLine,
@@ -35,3 +50,7 @@ def register():
         sale.SaleLine,
         stock.MoveSale,
         module='account_stock_eu_es', type_='model', depends=['sale'])
+    Pool.register(
+        account.LandedCost,
+        module='account_stock_eu_es', type_='model',
+        depends=['account_stock_landed_cost'])
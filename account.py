@@ -1,6 +1,6 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
 
 class FiscalYear(metaclass=PoolMeta):
@@ -9,3 +9,22 @@ class FiscalYear(metaclass=PoolMeta):
     @staticmethod
     def default_intrastat_extended():
         return True
+
+
+class LandedCost(metaclass=PoolMeta):
+    __name__ = 'account.landed_cost'
+
+    @classmethod
+    def on_modification(cls, mode, landed_costs, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        super().on_modification(mode, landed_costs, field_names=field_names)
+        if mode == 'write' and 'state' in field_names:
+            shipments = [str(s) for l in landed_costs for s in l.shipments]
+            if shipments:
+                Move.mark_intrastat_dirty(Move.search([
+                            ('shipment', 'in', shipments),
+                            ('state', '=', 'done'),
+                            ('intrastat_type', '!=', None),
+                            ], order=[]))
@@ -1,10 +1,263 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.model import fields, ModelView
-from trytond.pool import Pool
+import csv
+import datetime as dt
+import logging
+import time
+import zipfile
+from decimal import Decimal
+from io import BytesIO, TextIOWrapper
+
+from sql import Column
+
+from trytond.cache import Cache
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, If
+from trytond.tools import grouped_slice
 from trytond.wizard import Button, StateTransition, StateView, Wizard
 from trytond.transaction import Transaction
 
+from .stock import IntrastatBatch, IntrastatStats
+
+logger = logging.getLogger(__name__)
+
+
+class IntrastatTransport(metaclass=PoolMeta):
+    __name__ = 'account.stock.eu.intrastat.transport'
+
+    _code_cache = Cache(
+        'account.stock.eu.intrastat.transport.code', context=False)
+
+    @classmethod
+    def get(cls, code):
+        transport_id = cls._code_cache.get(code, -1)
+        if transport_id == -1:
+            transports = cls.search([
+                    ('code', '=', code),
+                    ], limit=1)
+            if transports:
+                transport, = transports
+                cls._code_cache.set(code, transport.id)
+            else:
+                transport = None
+                cls._code_cache.set(code, None)
+        elif transport_id is not None:
+            transport = cls(transport_id)
+        else:
+            transport = None
+        return transport
+
+    @classmethod
+    def on_modification(cls, mode, transports, field_names=None):
+        super().on_modification(mode, transports, field_names=field_names)
+        cls._code_cache.clear()
+
+
+class IntrastatDeclaration(metaclass=PoolMeta):
+    __name__ = 'account.stock.eu.intrastat.declaration'
+
+    @classmethod
+    def get(cls, company, country, date):
+        if Transaction().context.get('_intrastat_dry_run'):
+            # The declarations are neither created nor reopened
+            month = date.replace(day=1)
+            key = (company.id, country.id, month)
+            batch = IntrastatBatch.get()
+            declarations = batch.declarations if batch else {}
+            IntrastatStats.lookup('declarations', key in declarations)
+            if key not in declarations:
+                records = cls.search([
+                        ('company', '=', company.id),
+                        ('country', '=', country.id),
+                        ('month', '=', month),
+                        ], limit=1)
+                if records:
+                    declarations[key], = records
+                else:
+                    declarations[key] = cls(
+                        company=company, country=country, month=month)
+            return declarations[key]
+        return super().get(company, country, date)
+
+
+class IntrastatUpdateCheckpoint(ModelSQL):
+    "Intrastat Update Checkpoint"
+    __name__ = 'account.stock.eu.intrastat.update.checkpoint'
+
+    company = fields.Many2One(
+        'company.company', "Company", required=True, ondelete='CASCADE')
+    period = fields.Many2One(
+        'account.period', "Period", required=True, ondelete='CASCADE')
+    processing = fields.Selection([
+            ('chunked', "Chunked"),
+            ('queue', "Parallel Tasks"),
+            ], "Processing", required=True)
+    incremental = fields.Boolean("Incremental")
+    last_move = fields.Integer("Last Move", required=True)
+    moves_done = fields.Integer("Moves Done", required=True)
+    moves_changed = fields.Integer("Moves Changed", required=True)
+    tasks = fields.One2Many(
+        'account.stock.eu.intrastat.update.task', 'checkpoint', "Tasks")
+    declarations = fields.Many2Many(
+        'account.stock.eu.intrastat.update.checkpoint-declaration',
+        'checkpoint', 'declaration', "Declarations",
+        help="The declarations the update may leave empty.")
+
+    @classmethod
+    def default_incremental(cls):
+        return False
+
+    @classmethod
+    def default_last_move(cls):
+        return 0
+
+    @classmethod
+    def default_moves_done(cls):
+        return 0
+
+    @classmethod
+    def default_moves_changed(cls):
+        return 0
+
+    @classmethod
+    def get(cls, company, period, incremental, restart=False):
+        "Return the chunked checkpoint of the period to resume from"
+        checkpoints = cls.search([
+                ('company', '=', company),
+                ('period', '=', period),
+                ('processing', '=', 'chunked'),
+                ], order=[('id', 'DESC')])
+        # A checkpoint of the other mode would skip or add moves
+        resumable = [
+            c for c in checkpoints
+            if not restart and c.incremental == bool(incremental)]
+        if resumable:
+            checkpoint = resumable[0]
+            logger.info(
+                "Intrastat update of %s resumed after move %s: "
+                "%s moves done", checkpoint.period.rec_name,
+                checkpoint.last_move, checkpoint.moves_done)
+        else:
+            checkpoint = cls(
+                company=company, period=period, processing='chunked',
+                incremental=bool(incremental),
+                # The declarations of the discarded checkpoints are still to
+                # clean up
+                declarations=list({
+                        d for c in checkpoints for d in c.declarations}))
+            checkpoint.save()
+        cls.delete([c for c in checkpoints if c != checkpoint])
+        return checkpoint
+
+    @classmethod
+    def finish(cls, checkpoints):
+        """
+        Delete the declarations left empty by the checkpoints once all their
+        tasks are done
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Task = pool.get('account.stock.eu.intrastat.update.task')
+
+        # The finish is queued by each task so it can be run many times
+        cls.lock(checkpoints)
+        checkpoints = cls.search([
+                ('id', 'in', [c.id for c in checkpoints]),
+                ])
+        pending = {t.checkpoint for t in Task.search([
+                    ('checkpoint', 'in', [c.id for c in checkpoints]),
+                    ('state', '=', 'pending'),
+                    ])}
+        checkpoints = [c for c in checkpoints if c not in pending]
+        for checkpoint in checkpoints:
+            moves_done = checkpoint.moves_done + sum(
+                t.moves_done for t in checkpoint.tasks)
+            moves_changed = checkpoint.moves_changed + sum(
+                t.moves_changed for t in checkpoint.tasks)
+            Move.delete_orphan_intrastat_declarations(
+                checkpoint.declarations)
+            logger.info(
+                "Intrastat update of %s finished: %s moves changed, "
+                "%s unchanged",
+                checkpoint.period.rec_name, moves_changed,
+                moves_done - moves_changed)
+        cls.delete(checkpoints)
+
+
+class IntrastatUpdateCheckpointDeclaration(ModelSQL):
+    "Intrastat Update Checkpoint - Declaration"
+    __name__ = 'account.stock.eu.intrastat.update.checkpoint-declaration'
+
+    checkpoint = fields.Many2One(
+        'account.stock.eu.intrastat.update.checkpoint', "Checkpoint",
+        required=True, ondelete='CASCADE')
+    declaration = fields.Many2One(
+        'account.stock.eu.intrastat.declaration', "Declaration",
+        required=True, ondelete='CASCADE')
+
+
+class IntrastatUpdateTask(ModelSQL):
+    "Intrastat Update Task"
+    __name__ = 'account.stock.eu.intrastat.update.task'
+
+    checkpoint = fields.Many2One(
+        'account.stock.eu.intrastat.update.checkpoint', "Checkpoint",
+        required=True, ondelete='CASCADE')
+    state = fields.Selection([
+            ('pending', "Pending"),
+            ('done', "Done"),
+            ], "State", required=True)
+    moves_done = fields.Integer("Moves Done", required=True)
+    moves_changed = fields.Integer("Moves Changed", required=True)
+
+    @classmethod
+    def default_state(cls):
+        return 'pending'
+
+    @classmethod
+    def default_moves_done(cls):
+        return 0
+
+    @classmethod
+    def default_moves_changed(cls):
+        return 0
+
+    @classmethod
+    def process(cls, tasks, move_ids):
+        "Update the Intrastat of a partition of moves queued for the tasks"
+        pool = Pool()
+        Checkpoint = pool.get('account.stock.eu.intrastat.update.checkpoint')
+        CheckpointDeclaration = pool.get(
+            'account.stock.eu.intrastat.update.checkpoint-declaration')
+        Move = pool.get('stock.move')
+
+        moves = Move.browse(move_ids)
+        # The declarations the moves leave may end empty
+        declarations = {
+            m.intrastat_declaration for m in moves if m.intrastat_declaration}
+        changed, _ = Move._update_intrastat_moves(moves)
+        CheckpointDeclaration.create([{
+                    'checkpoint': t.checkpoint.id,
+                    'declaration': d.id,
+                    } for t in tasks for d in declarations])
+        # Each task only writes its own record so the tasks do not wait for
+        # each other
+        cls.write(tasks, {
+                'state': 'done',
+                'moves_done': len(move_ids),
+                'moves_changed': changed,
+                })
+        checkpoints = list({t.checkpoint for t in tasks})
+        for checkpoint in checkpoints:
+            logger.info(
+                "Intrastat update of %s: task of %s moves done "
+                "(%s changed)",
+                checkpoint.period.rec_name, len(move_ids), changed)
+        # The finish runs once this task is committed and does nothing while
+        # other tasks are pending, so the last committed task cleans up
+        Checkpoint.__queue__.finish(checkpoints)
+
 
 class IntrastatUpdateStart(ModelView):
     "Intrastat Update Start"
@@ -14,6 +267,64 @@ class IntrastatUpdateStart(ModelView):
         domain=[
             ('type', '=', 'standard'),
             ])
+    processing = fields.Selection([
+            ('single', "Single Transaction"),
+            ('chunked', "Chunked"),
+            ('queue', "Parallel Tasks"),
+            ], "Processing", required=True,
+        states={
+            'invisible': Eval('dry_run', False),
+            },
+        help="Chunked processing commits the moves by chunks and, when run "
+        "again, resumes after the last committed chunk.\n"
+        "Parallel tasks queue each chunk to be processed by the workers.")
+    chunk_size = fields.Integer("Chunk Size",
+        domain=[
+            If(Eval('processing').in_(['chunked', 'queue']),
+                ('chunk_size', '>', 0),
+                ()),
+            ],
+        states={
+            'invisible': (~Eval('processing').in_(['chunked', 'queue'])
+                | Eval('dry_run', False)),
+            'required': Eval('processing').in_(['chunked', 'queue']),
+            })
+
+    restart = fields.Boolean("Restart",
+        states={
+            'invisible': ((Eval('processing') != 'chunked')
+                | Eval('dry_run', False)),
+            },
+        help="Discard the progress of a previous chunked update of the "
+        "period instead of resuming it.")
+    incremental = fields.Boolean("Incremental",
+        help="Only update the moves whose Intrastat inputs changed since "
+        "they were computed.")
+    dry_run = fields.Boolean("Dry Run",
+        help="Only report the changes the update would make without "
+        "writing them.")
+
+    @classmethod
+    def default_processing(cls):
+        return 'single'
+
+    @classmethod
+    def default_chunk_size(cls):
+        return 1000
+
+
+class IntrastatUpdateResult(ModelView):
+    "Intrastat Update Result"
+    __name__ = 'account.stock.eu.intrastat.update.result'
+
+    moves_changed = fields.Integer("Moves Changed", readonly=True)
+    moves_unchanged = fields.Integer("Moves Unchanged", readonly=True)
+    field_changes = fields.Text("Field Changes", readonly=True)
+    declaration_deltas = fields.Text("Declaration Value Deltas",
+        readonly=True)
+    dropped_moves = fields.Many2Many(
+        'stock.move', None, None, "Dropped Moves", readonly=True,
+        help="The moves that would leave the Intrastat.")
 
 
 class IntrastatUpdate(Wizard):
@@ -26,38 +337,49 @@ class IntrastatUpdate(Wizard):
             Button("Update", 'update', 'tryton-ok'),
             ])
     update = StateTransition()
+    result = StateView(
+        'account.stock.eu.intrastat.update.result',
+        'account_stock_eu_es.intrastat_update_result_view_form', [
+            Button("Close", 'end', 'tryton-close'),
+            ])
 
     def _update_domain(self):
         pool = Pool()
+        Company = pool.get('company.company')
         Move = pool.get('stock.move')
 
-        shipment_domain = [
-            'OR',
-            ('shipment', 'ilike', 'stock.shipment.in,%'),
-            ('shipment', 'ilike', 'stock.shipment.out,%'),
-            ('shipment', 'ilike', 'stock.shipment.in.return,%'),
-            ('shipment', 'ilike', 'stock.shipment.out.return,%'),
-            ]
+        # The shipment models are selected with a case sensitive prefix and
+        # the companies by id so the clauses can use the indexes of the moves
+        shipment_domain = ['OR']
+        for model in self._update_shipment_models():
+            shipment_domain.append(('shipment', 'like', model + ',%'))
         if 'production_input' in Move._fields:
             shipment_domain.append(('production_input', '!=', None))
         if 'production_output' in Move._fields:
             shipment_domain.append(('production_output', '!=', None))
-        shipment_domain.append([
-                'OR',
-                ('shipment', 'ilike', 'stock.shipment.internal,%'),
-                ('shipment_price_list', '!=', None),
+        companies = Company.search([
+                ('intrastat', '=', True),
                 ])
 
         return [
             shipment_domain,
             ('state', '=', 'done'),
-            ('company.intrastat', '=', True),
+            ('company', 'in', [c.id for c in companies]),
             ]
 
-    def transition_update(self):
-        pool = Pool()
-        Move = pool.get('stock.move')
+    @classmethod
+    def _update_shipment_models(cls):
+        # The internal shipments are only in the Intrastat with a price list
+        # but all their moves are updated to reset those without one.
+        return [
+            'stock.shipment.in',
+            'stock.shipment.out',
+            'stock.shipment.in.return',
+            'stock.shipment.out.return',
+            'stock.shipment.internal',
+            ]
 
+    def _period_domain(self):
         start_date = self.start.period.start_date
         end_date = self.start.period.end_date
         company = Transaction().context.get('company')
@@ -67,6 +389,299 @@ class IntrastatUpdate(Wizard):
                 ('effective_date', '<=', end_date),
                 ('company', '=', company),
                 ])
-        moves = Move.search(domain)
-        Move.update_intrastat_declaration(moves)
+        if self.start.incremental:
+            domain.append(('intrastat_dirty', '=', True))
+        return domain
+
+    def transition_update(self):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        if self.start.dry_run:
+            return 'result'
+        elif self.start.processing == 'chunked':
+            self.update_chunked()
+        elif self.start.processing == 'queue':
+            self.update_queue()
+        else:
+            moves = Move.search(self._period_domain())
+            declarations = {
+                m.intrastat_declaration for m in moves
+                if m.intrastat_declaration}
+            changed, unchanged = Move.update_intrastat_declaration(moves)
+            Move.delete_orphan_intrastat_declarations(declarations)
+            logger.info(
+                "Intrastat update of %s finished: %s moves changed, "
+                "%s unchanged",
+                self.start.period.rec_name, changed, unchanged)
         return 'end'
+
+    def update_chunked(self):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Checkpoint = pool.get('account.stock.eu.intrastat.update.checkpoint')
+        transaction = Transaction()
+
+        period = self.start.period
+        domain = self._period_domain()
+        checkpoint = Checkpoint.get(
+            transaction.context.get('company'), period,
+            self.start.incremental, restart=self.start.restart)
+        # The moves already done by a resumed checkpoint may no longer match
+        # the domain, as the incremental update clears their flag
+        total = checkpoint.moves_done + Move.search_count(
+            domain + [('id', '>', checkpoint.last_move)])
+        start, done = time.monotonic(), 0
+        while True:
+            moves = Move.search(domain + [
+                    ('id', '>', checkpoint.last_move),
+                    ], order=[('id', 'ASC')], limit=self.start.chunk_size)
+            if not moves:
+                break
+            # The declarations the moves leave may end empty
+            declarations = {
+                m.intrastat_declaration for m in moves
+                if m.intrastat_declaration}
+            changed, _ = Move._update_intrastat_moves(moves)
+            checkpoint.declarations += tuple(
+                declarations - set(checkpoint.declarations))
+            checkpoint.last_move = moves[-1].id
+            checkpoint.moves_done += len(moves)
+            checkpoint.moves_changed += changed
+            checkpoint.save()
+            # Commit each chunk so a failure only loses the current one, this
+            # also clears the transaction cache.
+            transaction.commit()
+            done += len(moves)
+            logger.info(
+                "Intrastat update of %s: %s/%s moves (%.1f moves/s)",
+                period.rec_name, checkpoint.moves_done, total,
+                done / max(time.monotonic() - start, 1e-6))
+        # The declarations left empty are deleted once for the whole period
+        Checkpoint.finish([checkpoint])
+
+    def update_queue(self):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Checkpoint = pool.get('account.stock.eu.intrastat.update.checkpoint')
+        Task = pool.get('account.stock.eu.intrastat.update.task')
+        transaction = Transaction()
+
+        # Only the ids are read, each task reads its own moves
+        moves = Move.search(self._period_domain(), order=[('id', 'ASC')])
+        # Partition by ranges of ids so the tasks have the same size
+        partitions = [
+            list(map(int, p))
+            for p in grouped_slice(moves, self.start.chunk_size)]
+        # The parallel tasks would fail to create the same declaration
+        declarations = self._create_declarations()
+        checkpoint = Checkpoint(
+            company=transaction.context.get('company'),
+            period=self.start.period,
+            processing='queue',
+            incremental=self.start.incremental,
+            declarations=declarations,
+            tasks=[Task() for _ in partitions])
+        checkpoint.save()
+        if partitions:
+            for task, move_ids in zip(checkpoint.tasks, partitions):
+                Task.__queue__.process([task], move_ids)
+        else:
+            Checkpoint.__queue__.finish([checkpoint])
+
+    def _create_declarations(self):
+        """
+        Create the missing declarations of the period for the countries of
+        the warehouses of the moves to update and return them
+        """
+        pool = Pool()
+        Declaration = pool.get('account.stock.eu.intrastat.declaration')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        period = self.start.period
+        company = Transaction().context.get('company')
+        months = []
+        month = period.start_date.replace(day=1)
+        while month <= period.end_date:
+            months.append(month)
+            month = (month + dt.timedelta(days=31)).replace(day=1)
+        # The locations of the moves are grouped by the database so the
+        # warehouses are only those of the moves of the company
+        cursor.execute(*move.select(move.from_location, move.to_location,
+                where=move.id.in_(
+                    Move.search(self._period_domain(), query=True)),
+                group_by=[move.from_location, move.to_location]))
+        location_ids = {l for row in cursor for l in row}
+        warehouses = Location.get_warehouse_by_location(
+            Location.browse(location_ids)).values()
+        countries = {
+            w.address.country for w in warehouses
+            if w and w.address and w.address.country}
+
+        Declaration.lock()
+        existing = {(d.country, d.month) for d in Declaration.search([
+                    ('company', '=', company),
+                    ('country', 'in', [c.id for c in countries]),
+                    ('month', 'in', months),
+                    ])}
+        return Declaration.create([{
+                    'company': company,
+                    'country': country.id,
+                    'month': month,
+                    } for country in countries for month in months
+                if (country, month) not in existing])
+
+    def default_result(self, fields):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Lang = pool.get('ir.lang')
+
+        lang = Lang.get()
+        moves = Move.search(self._period_domain())
+        diff = Move.diff_intrastat_declaration(moves)
+        strings = {
+            n: f['string'] for n, f in Move.fields_get(
+                list(diff['fields'])).items()}
+        field_changes = [
+            '%s: %s' % (strings[name], count)
+            for name, count in sorted(diff['fields'].items())]
+        declaration_deltas = [
+            '%s: %s' % (key[0], lang.format_number(
+                    delta, digits=2, grouping=True, monetary=True))
+            for key, delta in sorted(diff['declarations'].items())]
+        return {
+            'moves_changed': diff['changed'],
+            'moves_unchanged': diff['unchanged'],
+            'field_changes': '\n'.join(field_changes),
+            'declaration_deltas': '\n'.join(declaration_deltas),
+            'dropped_moves': [m.id for m in diff['dropped']],
+            }
+
+
+class IntrastatDeclarationExport(metaclass=PoolMeta):
+    __name__ = 'account.stock.eu.intrastat.declaration.export'
+
+    def export_es(self, lines):
+        """
+        Return the zip of the files in the layout imported by the AEAT
+
+        The aggregated lines are read with their codes by a single query and
+        written while they are fetched instead of being read as records.
+        There is a file for each flow and each 999 lines as the AEAT accepts
+        at most 1000 lines by declaration.
+        """
+        pool = Pool()
+        Line = pool.get('account.stock.eu.intrastat.declaration.line')
+        declaration = self.record
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        relations = self._export_es_relations()
+        with transaction.set_context(
+                company=declaration.company.id,
+                declaration=declaration.id):
+            cursor.execute(*self._export_es_query(relations))
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            file = writer = type = None
+            index = count = 0
+            for row in cursor:
+                line = self._export_es_line(Line, relations, row)
+                if line.type != type or count >= 999:
+                    if file:
+                        file.close()
+                    index = index + 1 if line.type == type else 0
+                    type, count = line.type, 0
+                    file = TextIOWrapper(
+                        archive.open(f'{type}-{index}.csv', 'w'),
+                        encoding='utf-8', newline='')
+                    writer = csv.writer(file, delimiter=';')
+                writer.writerow(self.export_es_row(line))
+                count += 1
+            if file:
+                file.close()
+        return data.getvalue(), 'zip'
+
+    def _export_es_relations(self):
+        "Return the model and the field read of the relations of the lines"
+        return {
+            'country': ('country.country', 'code'),
+            'subdivision': ('country.subdivision', 'intrastat_code'),
+            'tariff_code': ('customs.tariff.code', 'code'),
+            'transaction': ('account.stock.eu.intrastat.transaction', 'code'),
+            'country_of_origin': ('country.country', 'code'),
+            'vat': ('party.identifier', 'code'),
+            'incoterm': ('incoterm.incoterm', 'code'),
+            'transport': ('account.stock.eu.intrastat.transport', 'code'),
+            }
+
+    def _export_es_query(self, relations):
+        "Return the query of the lines with the codes of their relations"
+        pool = Pool()
+        Line = pool.get('account.stock.eu.intrastat.declaration.line')
+
+        line = Line.__table__()
+        query = line
+        columns = [
+            line.id, line.type, line.weight, line.value,
+            line.additional_unit]
+        for name, (model, field) in relations.items():
+            table = pool.get(model).__table__()
+            query = query.join(table, 'LEFT',
+                condition=Column(line, name) == table.id)
+            columns.extend([Column(line, name), Column(table, field)])
+        # Same order as the lines
+        return query.select(*columns,
+            order_by=[line.type, line.country, line.tariff_code,
+                line.transaction, line.country_of_origin, line.vat,
+                line.id])
+
+    @staticmethod
+    def _export_es_line(Line, relations, row):
+        "Return the line instantiated with the values of the row"
+        pool = Pool()
+        id_, type, weight, value, additional_unit = row[:5]
+        values = {}
+        for i, (name, (model, field)) in enumerate(relations.items()):
+            related_id, code = row[5 + 2 * i:7 + 2 * i]
+            values[name] = (pool.get(model)(related_id, **{field: code})
+                if related_id is not None else None)
+        return Line(id_, type=type, weight=weight, value=value,
+            additional_unit=additional_unit, **values)
+
+    def export_es_row(self, line):
+        "Return the row in the layout of the file imported by the AEAT"
+        row = super().export_es_row(line)
+        dispatch = line.type == 'dispatch'
+        # The tariff code and the VAT number are without spaces and the
+        # numbers with a comma as decimal separator
+        row[6] = row[6].replace(' ', '') if row[6] else ''
+        row[8] = self._export_es_regime(line)
+        row[9] = self._format_es_number(line.weight, 3)
+        row[10] = self._format_es_number(line.additional_unit, 3)
+        row[11] = row[12] = self._format_es_number(line.value, 2)
+        row[13] = (
+            line.vat.code.replace(' ', '') if dispatch and line.vat else '')
+        return row
+
+    def _export_es_regime(self, line):
+        "Return the statistical regime of the line"
+        code = line.transaction.code if line.transaction else ''
+        # The transactions with a view to processing are temporary and the
+        # ones after processing are returns
+        if code.startswith('4'):
+            return '2'
+        elif code.startswith('5'):
+            return '3'
+        return '1'
+
+    @staticmethod
+    def _format_es_number(value, digits):
+        "Format the number with a comma as decimal separator"
+        if value is None:
+            return ''
+        value = Decimal(str(value)).quantize(Decimal(10) ** -digits)
+        return str(value).replace('.', ',')
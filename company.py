@@ -1,14 +1,43 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
 
 class Company(metaclass=PoolMeta):
     __name__ = 'company.company'
 
     intrastat = fields.Boolean("Intrastat")
+    _intrastat_country_cache = Cache(
+        'company.company.intrastat_country', context=False)
 
     @staticmethod
     def default_intrastat():
         return True
+
+    @classmethod
+    def get_intrastat_country(cls, company):
+        """
+        Return the Intrastat flag and the country of the company
+
+        The country is the one of the invoice address of the company party.
+        """
+        pool = Pool()
+        Country = pool.get('country.country')
+        company_id = int(company)
+        values = cls._intrastat_country_cache.get(company_id)
+        if values is None:
+            company = cls(company_id)
+            address = company.party.address_get(type='invoice')
+            country = address.country if address else None
+            values = (company.intrastat, country.id if country else None)
+            cls._intrastat_country_cache.set(company_id, values)
+        intrastat, country_id = values
+        country = Country(country_id) if country_id is not None else None
+        return intrastat, country
+
+    @classmethod
+    def on_modification(cls, mode, companies, field_names=None):
+        super().on_modification(mode, companies, field_names=field_names)
+        cls._intrastat_country_cache.clear()
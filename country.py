@@ -2,6 +2,8 @@
 # this repository contains the full copyright notices and license terms.
 from trytond.pool import PoolMeta
 
+from .stock import IntrastatBatch, IntrastatStats
+
 
 class Country(metaclass=PoolMeta):
     __name__ = 'country.country'
@@ -9,3 +11,15 @@ class Country(metaclass=PoolMeta):
     @property
     def is_in_intrastat(self):
         return self.in_intrastat()
+
+    def in_intrastat(self, *args, **kwargs):
+        batch = IntrastatBatch.get()
+        if batch is None or self.id is None or self.id < 0:
+            return super().in_intrastat(*args, **kwargs)
+        key = (self.id, args, tuple(sorted(kwargs.items())))
+        IntrastatStats.lookup(
+            'intrastat countries', key in batch.intrastat_countries)
+        if key not in batch.intrastat_countries:
+            batch.intrastat_countries[key] = super().in_intrastat(
+                *args, **kwargs)
+        return batch.intrastat_countries[key]
@@ -0,0 +1,38 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+from .stock import IntrastatBatch
+
+
+class ProductTariffCode(metaclass=PoolMeta):
+    __name__ = 'product-customs.tariff.code'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Category = pool.get('product.category')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+
+        super().on_modification(mode, records, field_names=field_names)
+        batch = IntrastatBatch.get()
+        if batch:
+            batch.tariff_codes.clear()
+        templates = {
+            r.product.id for r in records
+            if isinstance(r.product, Template)}
+        categories = [
+            r.product.id for r in records
+            if isinstance(r.product, Category)]
+        if categories:
+            templates.update(map(int, Template.search([
+                            ('customs_category', 'in', categories),
+                            ('tariff_codes_category', '=', True),
+                            ])))
+        if templates:
+            Move.mark_intrastat_dirty(Move.search([
+                        ('product.template', 'in', list(templates)),
+                        ('state', '=', 'done'),
+                        ('intrastat_type', '!=', None),
+                        ], order=[]))
@@ -0,0 +1,35 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+
+
+class Incoterm(metaclass=PoolMeta):
+    __name__ = 'incoterm.incoterm'
+
+    _code_cache = Cache('incoterm.incoterm.code', context=False)
+
+    @classmethod
+    def get(cls, code):
+        "Return the last incoterm with the code"
+        incoterm_id = cls._code_cache.get(code, -1)
+        if incoterm_id == -1:
+            incoterms = cls.search([
+                    ('code', '=', code),
+                    ], order=[('id', 'DESC')], limit=1)
+            if incoterms:
+                incoterm, = incoterms
+                cls._code_cache.set(code, incoterm.id)
+            else:
+                incoterm = None
+                cls._code_cache.set(code, None)
+        elif incoterm_id is not None:
+            incoterm = cls(incoterm_id)
+        else:
+            incoterm = None
+        return incoterm
+
+    @classmethod
+    def on_modification(cls, mode, incoterms, field_names=None):
+        super().on_modification(mode, incoterms, field_names=field_names)
+        cls._code_cache.clear()
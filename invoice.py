@@ -1,9 +1,14 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
+from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 from trytond.model import ModelSQL, fields
 from trytond.modules.company.model import CompanyValueMixin
+from trytond.transaction import Transaction
+
+from .stock import IntrastatStats
 
 
 class Configuration(metaclass=PoolMeta):
@@ -13,14 +18,50 @@ class Configuration(metaclass=PoolMeta):
         fields.Many2One('product.product', "Intrastat Discount Product",
             help="If setted, when calcaulate the amount of the Intrastata move"
             " it take the discount line if exit from the same invoice."))
+    intrastat_update_delay = fields.MultiValue(
+        fields.TimeDelta("Intrastat Update Delay",
+            help="If set, the Intrastat of the moves of the posted invoices "
+            "is updated by a queue task after this delay.\n"
+            "Leave empty to update it when posting."))
+    _intrastat_discount_product_cache = Cache(
+        'account.configuration.intrastat_discount_product', context=False)
+    _intrastat_update_delay_cache = Cache(
+        'account.configuration.intrastat_update_delay', context=False)
 
     @classmethod
     def multivalue_model(cls, field):
         pool = Pool()
-        if field in {'intrastat_discount_product'}:
+        if field in {'intrastat_discount_product', 'intrastat_update_delay'}:
             return pool.get('account.configuration.intrastat')
         return super().multivalue_model(field)
 
+    @classmethod
+    def get_intrastat_discount_product(cls):
+        "Return the Intrastat discount product of the company"
+        pool = Pool()
+        Product = pool.get('product.product')
+        company = Transaction().context.get('company')
+        product_id = cls._intrastat_discount_product_cache.get(company, -1)
+        if product_id == -1:
+            product = cls(1).intrastat_discount_product
+            cls._intrastat_discount_product_cache.set(
+                company, product.id if product else None)
+        elif product_id is not None:
+            product = Product(product_id)
+        else:
+            product = None
+        return product
+
+    @classmethod
+    def get_intrastat_update_delay(cls):
+        "Return the Intrastat update delay of the company"
+        company = Transaction().context.get('company')
+        delay = cls._intrastat_update_delay_cache.get(company, -1)
+        if delay == -1:
+            delay = cls(1).intrastat_update_delay
+            cls._intrastat_update_delay_cache.set(company, delay)
+        return delay
+
 
 class ConfigurationIntrastat(ModelSQL, CompanyValueMixin):
     "Account Configuration Intrastat"
@@ -28,6 +69,15 @@ class ConfigurationIntrastat(ModelSQL, CompanyValueMixin):
 
     intrastat_discount_product = fields.Many2One('product.product',
         "Intrastat Discout Product")
+    intrastat_update_delay = fields.TimeDelta("Intrastat Update Delay")
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._intrastat_discount_product_cache.clear()
+        Configuration._intrastat_update_delay_cache.clear()
 
 
 class Invoice(metaclass=PoolMeta):
@@ -39,8 +89,7 @@ class Invoice(metaclass=PoolMeta):
         InvoiceLine = pool.get('account.invoice.line')
         Configuration = pool.get('account.configuration')
 
-        config = Configuration(1)
-        discount_product = config.intrastat_discount_product
+        discount_product = Configuration.get_intrastat_discount_product()
         # Needs invoices in order from old to new, to ensure apply correctly
         # the amount of each line in the time order.
         invoices = cls.search([
@@ -79,17 +128,63 @@ class Invoice(metaclass=PoolMeta):
             lines = {l: Decimal(0) for i in invoices for l in i.lines}
         return lines
 
+    @classmethod
+    def set_intrastat_amount(cls, invoices):
+        "Store on the lines the amount used for the Intrastat value"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        # Only the amounts of the lines with stock moves are used
+        invoices = [
+            i for i in invoices if any(l.stock_moves for l in i.lines)]
+        if not invoices:
+            return
+        amounts = defaultdict(list)
+        for line, amount in cls.get_invoice_intrastat_discount_per_line(
+                invoices).items():
+            if line.stock_moves:
+                amounts[amount].append(line)
+        to_write = []
+        for amount, lines in amounts.items():
+            to_write.extend([lines, {'intrastat_amount': amount}])
+        if to_write:
+            with IntrastatStats.stage('save'):
+                InvoiceLine.write(*to_write)
+
+    @classmethod
+    def clear_intrastat_amount(cls, invoices):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        lines = [l for i in invoices for l in i.lines
+            if l.intrastat_amount is not None]
+        if lines:
+            InvoiceLine.write(lines, {'intrastat_amount': None})
+
     @classmethod
     def _post(cls, invoices):
         pool = Pool()
         Move = pool.get('stock.move')
+        Configuration = pool.get('account.configuration')
 
         # Get all the stock move related with the invoce lines, to update they
         # intrastat_value if it's required.
-        lines = [l for i in invoices for l in i.lines]
-        moves = [m for l in lines for m in l.stock_moves]
+        with IntrastatStats.stage('invoice'):
+            lines = [l for i in invoices for l in i.lines]
+            moves = list({m for l in lines for m in l.stock_moves})
         super()._post(invoices)
-        Move.update_intrastat_declaration(moves)
+        with IntrastatStats.stage('invoice'):
+            cls.set_intrastat_amount(invoices)
+            delay = Configuration.get_intrastat_update_delay()
+            if delay is not None:
+                # Only the deferred moves are flagged, so the incremental
+                # update processes them if the task has not run yet
+                if moves:
+                    Move.mark_intrastat_dirty(moves)
+                    with Transaction().set_context(queue_scheduled_at=delay):
+                        Move.__queue__.update_intrastat_dirty(moves)
+            else:
+                Move.update_intrastat_declaration(moves)
 
     @classmethod
     def cancel(cls, invoices):
@@ -97,14 +192,14 @@ class Invoice(metaclass=PoolMeta):
         Move = pool.get('stock.move')
 
         super().cancel(invoices)
-        # Get all the sotck move related with the invoce lines, to remove from
-        # the Intrastata report.
-        lines = [l for i in invoices for l in i.lines]
-        moves = [m for l in lines for m in l.stock_moves
-            if m.intrastat_type is not None]
-        Move.reset_intrastat(moves)
-        moves = Move.browse(moves)
-        Move.update_intrastat_declaration(moves)
+        with IntrastatStats.stage('invoice'):
+            cls.clear_intrastat_amount(invoices)
+            # Get all the sotck move related with the invoce lines, to remove
+            # from the Intrastata report.
+            lines = [l for i in invoices for l in i.lines]
+            moves = list({m for l in lines for m in l.stock_moves
+                    if m.intrastat_type is not None})
+            Move.reset_intrastat(moves)
 
     @classmethod
     def draft(cls, invoices):
@@ -112,14 +207,33 @@ class Invoice(metaclass=PoolMeta):
         Move = pool.get('stock.move')
 
         super().draft(invoices)
-        # Get all the sotck move related with the invoce lines, to remove from
-        # the Intrastata report.
-        lines = [l for i in invoices for l in i.lines]
-        moves = [m for l in lines for m in l.stock_moves
-            if m.intrastat_cancelled]
-        values = {
-            'intrastat_cancelled': False,
-            }
-        Move.write(moves, values)
-        moves = Move.browse(moves)
-        Move.update_intrastat_declaration(moves)
+        with IntrastatStats.stage('invoice'):
+            cls.clear_intrastat_amount(invoices)
+            # Get all the sotck move related with the invoce lines, to remove
+            # from the Intrastata report.
+            lines = [l for i in invoices for l in i.lines]
+            moves = list({m for l in lines for m in l.stock_moves
+                    if m.intrastat_cancelled})
+            # The moves are no more cancelled when they are updated
+            with Transaction().set_context(_intrastat_reopen_cancelled=True):
+                Move.update_intrastat_declaration(moves)
+
+
+class InvoiceLine(metaclass=PoolMeta):
+    __name__ = 'account.invoice.line'
+
+    intrastat_amount = fields.Numeric("Intrastat Amount", readonly=True,
+        help="The amount of the line used for the Intrastat value, "
+        "including its share of the Intrastat discount.\n"
+        "Set when the invoice is posted.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._check_modify_exclude.add('intrastat_amount')
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        default = default.copy() if default is not None else {}
+        default.setdefault('intrastat_amount', None)
+        return super().copy(lines, default=default)
@@ -0,0 +1,53 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class Incoterm(metaclass=PoolMeta):
+    __name__ = 'party.incoterm'
+
+    @classmethod
+    def on_modification(cls, mode, incoterms, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        super().on_modification(mode, incoterms, field_names=field_names)
+        suppliers = [i.party.id for i in incoterms if i.type == 'purchase']
+        customers = [i.party.id for i in incoterms if i.type == 'sale']
+        domain = ['OR']
+        if suppliers:
+            domain.extend([
+                    ('shipment.supplier', 'in', suppliers,
+                        'stock.shipment.in'),
+                    ('shipment.supplier', 'in', suppliers,
+                        'stock.shipment.in.return'),
+                    ])
+        if customers:
+            domain.extend([
+                    ('shipment.customer', 'in', customers,
+                        'stock.shipment.out'),
+                    ('shipment.customer', 'in', customers,
+                        'stock.shipment.out.return'),
+                    ])
+        if len(domain) > 1:
+            Move.mark_intrastat_dirty(Move.search([
+                        domain,
+                        ('state', '=', 'done'),
+                        ('intrastat_type', '!=', None),
+                        ], order=[]))
+
+
+class Address(metaclass=PoolMeta):
+    __name__ = 'party.address'
+
+    @classmethod
+    def on_modification(cls, mode, addresses, field_names=None):
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        super().on_modification(mode, addresses, field_names=field_names)
+        if ((mode == 'write' and 'party' in field_names)
+                or Company.search([
+                        ('party', 'in', list({a.party.id for a in addresses})),
+                        ], limit=1)):
+            Company._intrastat_country_cache.clear()
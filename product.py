@@ -0,0 +1,114 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from collections import defaultdict
+
+from trytond import backend
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+
+from .stock import IntrastatBatch, IntrastatStats
+
+
+class Product(metaclass=PoolMeta):
+    __name__ = 'product.product'
+
+    def get_tariff_code(self, pattern):
+        batch = IntrastatBatch.get()
+        if batch is None or self.id is None or self.id < 0:
+            return super().get_tariff_code(pattern)
+        key = (self.id, tuple(sorted(pattern.items())))
+        IntrastatStats.lookup('tariff codes', key in batch.tariff_codes)
+        if key not in batch.tariff_codes:
+            batch.tariff_codes[key] = super().get_tariff_code(pattern)
+        return batch.tariff_codes[key]
+
+    @classmethod
+    def get_tariff_code_by_product(cls, products, pattern):
+        """
+        Return a dictionary with the tariff code of each product id
+
+        The tariff codes of the templates or categories of all the products
+        are searched at once and kept for the batch.
+        """
+        pool = Pool()
+        Product_TariffCode = pool.get('product-customs.tariff.code')
+
+        batch = IntrastatBatch.get()
+        tariff_codes = batch.tariff_codes if batch else {}
+        pattern_key = tuple(sorted(pattern.items()))
+        codes, owners = {}, {}
+        for product in products:
+            key = (product.id, pattern_key)
+            IntrastatStats.lookup('tariff codes', key in tariff_codes)
+            if key in tariff_codes:
+                codes[product.id] = tariff_codes[key]
+            elif product.id is None or product.id < 0:
+                codes[product.id] = product.get_tariff_code(pattern)
+            else:
+                owners[product] = product._tariff_code_owner()
+
+        links = defaultdict(list)
+        owner_ids = {str(o) for o in owners.values() if o}
+        for sub_ids in grouped_slice(owner_ids, backend.MAX_QUERY_PARAMS):
+            for link in Product_TariffCode.search([
+                        ('product', 'in', list(sub_ids)),
+                        ], order=[
+                        ('sequence', 'ASC NULLS FIRST'),
+                        ('id', 'ASC'),
+                        ]):
+                links[str(link.product)].append(link.tariff_code)
+        for product, owner in owners.items():
+            codes[product.id] = tariff_codes[(product.id, pattern_key)] = (
+                next((c for c in links[str(owner)] if c.match(pattern)),
+                    None))
+        return codes
+
+    def _tariff_code_owner(self):
+        "Return the template or category that holds the tariff codes"
+        if not self.template.tariff_codes_category:
+            return self.template
+        owner = self.template.customs_category
+        while owner and owner.tariff_codes_parent:
+            owner = owner.parent
+        return owner
+
+
+class ProductCostPrice(metaclass=PoolMeta):
+    __name__ = 'product.cost_price'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        super().on_modification(mode, records, field_names=field_names)
+        if mode == 'write' and 'cost_price' not in field_names:
+            return
+        products = defaultdict(set)
+        for record in records:
+            if record.product:
+                company = record.company.id if record.company else None
+                products[company].add(record.product.id)
+        if not products:
+            return
+        domain = ['OR']
+        for company, product_ids in products.items():
+            clause = [('product', 'in', list(product_ids))]
+            if company is not None:
+                clause.append(('company', '=', company))
+            domain.append(clause)
+        # Only the moves without price are valued at the cost price, the
+        # moves of closed declarations are flagged like by the other inputs
+        Move.mark_intrastat_dirty(Move.search([
+                    domain,
+                    ('state', '=', 'done'),
+                    ('intrastat_type', '!=', None),
+                    ['OR',
+                        ('unit_price', '=', None),
+                        ('unit_price', '=', 0),
+                        ],
+                    ['OR',
+                        ('shipment', '=', None),
+                        ('shipment', 'not like', 'stock.shipment.internal,%'),
+                        ],
+                    ], order=[]))
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark the Intrastat hot paths on synthetic data
+
+The database must be a new database with account_stock_eu_es activated, the
+data of each scale is generated in its own month of the previous year.
+"""
+import datetime as dt
+import json
+import os
+import platform
+import sys
+import time
+from argparse import ArgumentParser
+from decimal import Decimal
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+try:
+    from trytond import __version__ as trytond_version
+    from trytond.config import config
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("trytond must be installed to use %s" % prog)
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+MOVES_PER_SHIPMENT = 10
+# One move over LANDED_COST_RATIO is received with a landed cost and one
+# over CONSIGNMENT_RATIO is sent by an internal consignment shipment
+LANDED_COST_RATIO = 10
+CONSIGNMENT_RATIO = 10
+
+
+def _create_country(code, name):
+    from trytond.pool import Pool
+    pool = Pool()
+    Country = pool.get('country.country')
+    Organization = pool.get('country.organization')
+
+    countries = Country.search([('code', '=', code)], limit=1)
+    if countries:
+        country, = countries
+    else:
+        country, = Country.create([{'name': name, 'code': code}])
+    if code != 'CN':
+        europe, = Organization.search([('code', '=', 'EU')], limit=1)
+        if country not in {m.country for m in europe.members}:
+            Organization.write([europe], {
+                    'members': [('create', [{'country': country.id}])],
+                    })
+    return country
+
+
+def setup(companies, products):
+    "Create the records shared by all the scales"
+    from trytond.modules.account.tests import create_chart
+    from trytond.modules.company.tests import create_company, set_company
+    from trytond.modules.currency.tests import add_currency_rate
+    from trytond.pool import Pool
+    pool = Pool()
+    Account = pool.get('account.account')
+    AccountConfiguration = pool.get('account.configuration')
+    Category = pool.get('product.category')
+    Currency = pool.get('currency.currency')
+    Incoterm = pool.get('incoterm.incoterm')
+    Location = pool.get('stock.location')
+    Party = pool.get('party.party')
+    PriceList = pool.get('product.price_list')
+    Subdivision = pool.get('country.subdivision')
+    TariffCode = pool.get('customs.tariff.code')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    belgium = _create_country('BE', "Belgium")
+    france = _create_country('FR', "France")
+    china = _create_country('CN', "China")
+    region, = Subdivision.create([{
+                'name': "Walloon Region",
+                'country': belgium.id,
+                'type': 'region',
+                'intrastat_code': '2',
+                }])
+    unit, = Uom.search([('name', '=', "Unit")])
+    kg, = Uom.search([('name', '=', "Kilogram")])
+    tariff_codes = TariffCode.create([{
+                'code': '9403 10 %02d' % i,
+                'description': "Desks %s" % i,
+                'intrastat_uom': unit.id,
+                } for i in range(10)])
+    dap, = Incoterm.search([
+            ('code', '=', 'DAP'), ('version', '=', '2020')], limit=1)
+
+    currencies = Currency.search([('code', '=', 'EUR')], limit=1)
+    if currencies:
+        eur, = currencies
+    else:
+        eur, = Currency.create([{
+                    'name': "Euro", 'code': 'EUR', 'symbol': "€"}])
+        add_currency_rate(eur, 1)
+
+    warehouse, = Location.search([('code', '=', 'WH')])
+    consignment, = Location.copy([warehouse], default={
+            'name': "Consignment FR",
+            'code': 'CFR',
+            })
+    consignee, = Party.create([{
+                'name': "Consignee FR",
+                'addresses': [('create', [{'country': france.id}])],
+                }])
+    Location.write([consignment], {'address': consignee.addresses[0].id})
+
+    result = {
+        'warehouse': warehouse.id,
+        'consignment': consignment.id,
+        'companies': [],
+        }
+    for index in range(companies):
+        company = create_company(name="Company %s" % index, currency=eur)
+        with set_company(company):
+            address, = company.party.addresses
+            address.country = belgium
+            address.subdivision = region
+            address.invoice = True
+            address.save()
+            if not warehouse.address:
+                warehouse.address = address
+                warehouse.save()
+            create_chart(company)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            category, = Category.create([{
+                        'name': "Category %s" % index,
+                        'accounting': True,
+                        'account_revenue': revenue.id,
+                        'account_expense': expense.id,
+                        }])
+            templates = Template.create([{
+                        'name': "Product %s" % i,
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'account_category': category.id,
+                        'weight': 2,
+                        'weight_uom': kg.id,
+                        'country_of_origin': china.id,
+                        'tariff_codes': [('create', [{
+                                        'tariff_code': tariff_codes[
+                                            i % len(tariff_codes)].id,
+                                        }])],
+                        'products': [('create', [{
+                                        'cost_price': Decimal(10 + i % 90),
+                                        }])],
+                        } for i in range(products)])
+            discount, = Template.create([{
+                        'name': "Discount",
+                        'type': 'service',
+                        'default_uom': unit.id,
+                        'account_category': category.id,
+                        'products': [('create', [{}])],
+                        }])
+            configuration = AccountConfiguration(1)
+            configuration.intrastat_discount_product = discount.products[0]
+            configuration.save()
+            customers = Party.create([{
+                        'name': "Customer FR %s-%s" % (index, i),
+                        'addresses': [('create', [{'country': france.id}])],
+                        'identifiers': [('create', [{
+                                        'type': 'eu_vat',
+                                        'code': 'FR40303265045',
+                                        }])],
+                        'sale_incoterms': [('create', [{
+                                        'type': 'sale',
+                                        'company': company.id,
+                                        'incoterm': dap.id,
+                                        }])],
+                        } for i in range(10)])
+            supplier, = Party.create([{
+                        'name': "Supplier FR %s" % index,
+                        'addresses': [('create', [{'country': france.id}])],
+                        }])
+            price_list, = PriceList.create([{
+                        'name': "Consignment %s" % index,
+                        'company': company.id,
+                        'lines': [('create', [{
+                                        'formula': 'cost_price * 1.1',
+                                        }])],
+                        }])
+        result['companies'].append({
+                'company': company.id,
+                'products': [t.products[0].id for t in templates],
+                'discount': discount.products[0].id,
+                'customers': [c.id for c in customers],
+                'supplier': supplier.id,
+                'price_list': price_list.id,
+                })
+    return result
+
+
+def _browse(values):
+    """
+    Return the records of the ids of values in the current transaction
+
+    The records of a company must be browsed with the company in the context.
+    """
+    from trytond.pool import Pool
+    pool = Pool()
+    models = {
+        'warehouse': 'stock.location',
+        'consignment': 'stock.location',
+        'company': 'company.company',
+        'products': 'product.product',
+        'discount': 'product.product',
+        'customers': 'party.party',
+        'supplier': 'party.party',
+        'price_list': 'product.price_list',
+        }
+    records = {}
+    for name, value in values.items():
+        if name not in models:
+            continue
+        Model = pool.get(models[name])
+        if isinstance(value, list):
+            records[name] = Model.browse(value)
+        else:
+            records[name] = Model(value)
+    return records
+
+
+def _run(database, func, *args, **kwargs):
+    "Run func in a committed transaction retried on the lock errors"
+    from trytond.transaction import Transaction, TransactionError
+    extras = {}
+    while True:
+        with Transaction().start(database, 0, **extras) as transaction:
+            try:
+                return func(*args, **kwargs)
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+
+
+def create_fiscalyears(data, year):
+    "Create the fiscal year of the benchmarks with monthly periods"
+    from trytond.modules.account.tests import get_fiscalyear
+    from trytond.modules.account_invoice.tests import set_invoice_sequences
+    from trytond.modules.company.tests import set_company
+    from trytond.pool import Pool
+    pool = Pool()
+    FiscalYear = pool.get('account.fiscalyear')
+
+    Company = pool.get('company.company')
+
+    for values in data['companies']:
+        company = Company(values['company'])
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company, today=dt.date(year, 1, 1))
+            # The transport and the incoterm are not required
+            fiscalyear.intrastat_extended = False
+            set_invoice_sequences(fiscalyear)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+
+
+def generate(data, moves, date):
+    """
+    Generate the moves of a scale for the date split between the companies
+
+    Return the ids of the invoices of the dispatched moves.
+    """
+    from trytond.modules.company.tests import set_company
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    pool = Pool()
+    Company = pool.get('company.company')
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+    Move = pool.get('stock.move')
+    ShipmentIn = pool.get('stock.shipment.in')
+    ShipmentInternal = pool.get('stock.shipment.internal')
+    ShipmentOut = pool.get('stock.shipment.out')
+    try:
+        LandedCost = pool.get('account.landed_cost')
+    except KeyError:
+        LandedCost = None
+
+    records = _browse(data)
+    warehouse = records['warehouse']
+    consignment = records['consignment']
+    invoices = []
+    per_company = max(moves // len(data['companies']), 1)
+    for values in data['companies']:
+        with set_company(Company(values['company'])), \
+                Transaction().set_context(_skip_warnings=True):
+            values = _browse(values)
+            company = values['company']
+            products = values['products']
+            customers = values['customers']
+            supplier = values['supplier']
+            n_arrival = per_company // LANDED_COST_RATIO
+            n_consignment = per_company // CONSIGNMENT_RATIO
+            n_dispatch = per_company - n_arrival - n_consignment
+
+            to_do = []
+            shipments = ShipmentOut.create([{
+                        'company': company.id,
+                        'customer': customers[i % len(customers)].id,
+                        'delivery_address': (
+                            customers[i % len(customers)].addresses[0].id),
+                        'warehouse': warehouse.id,
+                        'warehouse_storage': warehouse.storage_location.id,
+                        'warehouse_output': warehouse.output_location.id,
+                        'planned_date': date,
+                        } for i in range(
+                        -(-n_dispatch // MOVES_PER_SHIPMENT))])
+            dispatch_moves = Move.create([{
+                        'company': company.id,
+                        'product': products[i % len(products)].id,
+                        'unit': products[i % len(products)].default_uom.id,
+                        'quantity': 1 + i % 5,
+                        'from_location': warehouse.output_location.id,
+                        'to_location': shipment.customer.customer_location.id,
+                        'unit_price': Decimal(20 + i % 80),
+                        'currency': company.currency.id,
+                        'planned_date': date,
+                        'effective_date': date,
+                        'shipment': str(shipment),
+                        } for i, shipment in (
+                        (i, shipments[i // MOVES_PER_SHIPMENT])
+                        for i in range(n_dispatch))])
+            to_do.extend(dispatch_moves)
+
+            shipments = ShipmentIn.create([{
+                        'company': company.id,
+                        'supplier': supplier.id,
+                        'warehouse': warehouse.id,
+                        'warehouse_input': warehouse.input_location.id,
+                        'warehouse_storage': warehouse.storage_location.id,
+                        'planned_date': date,
+                        } for _ in range(
+                        -(-n_arrival // MOVES_PER_SHIPMENT))])
+            Move.create([{
+                        'company': company.id,
+                        'product': products[i % len(products)].id,
+                        'unit': products[i % len(products)].default_uom.id,
+                        'quantity': 1 + i % 5,
+                        'from_location': supplier.supplier_location.id,
+                        'to_location': warehouse.input_location.id,
+                        'unit_price': Decimal(10 + i % 50),
+                        'currency': company.currency.id,
+                        'planned_date': date,
+                        'effective_date': date,
+                        'shipment': str(shipment),
+                        } for i, shipment in (
+                        (i, shipments[i // MOVES_PER_SHIPMENT])
+                        for i in range(n_arrival))])
+            ShipmentIn.receive(shipments)
+            if LandedCost and shipments:
+                LandedCost.create([{
+                            'company': company.id,
+                            'shipments': [('add', [s.id for s in shipments])],
+                            }])
+
+            shipments = ShipmentInternal.create([{
+                        'company': company.id,
+                        'from_location': warehouse.storage_location.id,
+                        'to_location': consignment.storage_location.id,
+                        'price_list': values['price_list'].id,
+                        'planned_date': date,
+                        'planned_start_date': date,
+                        } for _ in range(
+                        -(-n_consignment // MOVES_PER_SHIPMENT))])
+            to_do.extend(Move.create([{
+                            'company': company.id,
+                            'product': products[i % len(products)].id,
+                            'unit': (
+                                products[i % len(products)].default_uom.id),
+                            'quantity': 1 + i % 5,
+                            'from_location': (
+                                warehouse.storage_location.id),
+                            'to_location': (
+                                consignment.storage_location.id),
+                            'planned_date': date,
+                            'effective_date': date,
+                            'shipment': str(shipment),
+                            } for i, shipment in (
+                            (i, shipments[i // MOVES_PER_SHIPMENT])
+                            for i in range(n_consignment))]))
+            Move.do(to_do)
+
+            # One invoice per customer shipment with a discount line
+            shipment_moves = {}
+            for move in dispatch_moves:
+                shipment_moves.setdefault(move.shipment, []).append(move)
+            company_invoices = []
+            for shipment, sub_moves in shipment_moves.items():
+                invoice = Invoice(
+                    company=company,
+                    type='out',
+                    party=shipment.customer,
+                    invoice_date=date,
+                    currency=company.currency)
+                invoice.on_change_type()
+                invoice.on_change_party()
+                lines = []
+                for move in sub_moves:
+                    lines.append(_invoice_line(
+                            InvoiceLine, company, move.product,
+                            move.quantity, move.unit_price, [move]))
+                lines.append(_invoice_line(
+                        InvoiceLine, company, values['discount'],
+                        1, -Decimal(len(sub_moves)), []))
+                invoice.lines = lines
+                company_invoices.append(invoice)
+            Invoice.save(company_invoices)
+            invoices.extend(i.id for i in company_invoices)
+    return invoices
+
+
+def _invoice_line(InvoiceLine, company, product, quantity, unit_price, moves):
+    line = InvoiceLine()
+    line.type = 'line'
+    line.invoice_type = 'out'
+    line.company = company
+    line.currency = company.currency
+    line.product = product
+    line.unit = product.default_uom
+    line.quantity = quantity
+    line.unit_price = unit_price
+    line.account = product.account_revenue_used
+    line.stock_moves = moves
+    return line
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def time_company(data, company_id, invoice_ids, date):
+    "Time each hot path on the moves and invoices of the company"
+    from trytond.modules.company.tests import set_company
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    pool = Pool()
+    Company = pool.get('company.company')
+    Invoice = pool.get('account.invoice')
+    Move = pool.get('stock.move')
+
+    company = Company(company_id)
+    with set_company(company), \
+            Transaction().set_context(_skip_warnings=True):
+        invoices = Invoice.search([
+                ('id', 'in', invoice_ids),
+                ('company', '=', company.id),
+                ])
+        moves = Move.search([
+                ('company', '=', company.id),
+                ('effective_date', '>=', date.replace(day=1)),
+                ('effective_date', '<=', date),
+                ('state', '=', 'done'),
+                ])
+        return {
+            'invoice_post': _timed(Invoice.post, invoices),
+            'invoice_discount': _timed(
+                Invoice.get_invoice_intrastat_discount_per_line, invoices),
+            'update_intrastat_declaration': _timed(
+                Move.update_intrastat_declaration, moves),
+            'update_intrastat_declaration_unchanged': _timed(
+                Move.update_intrastat_declaration, moves),
+            'diff_intrastat_declaration': _timed(
+                Move.diff_intrastat_declaration, moves),
+            }
+
+
+def time_export(company_id, date):
+    "Time the export of the declarations of the company"
+    from trytond.modules.company.tests import set_company
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    pool = Pool()
+    Company = pool.get('company.company')
+    Declaration = pool.get('account.stock.eu.intrastat.declaration')
+    Export = pool.get(
+        'account.stock.eu.intrastat.declaration.export', type='wizard')
+
+    def export():
+        declarations = Declaration.search([
+                ('company', '=', company_id),
+                ('month', '=', date.replace(day=1)),
+                ])
+        for declaration in declarations:
+            with Transaction().set_context(
+                    active_model=Declaration.__name__,
+                    active_id=declaration.id,
+                    active_ids=[declaration.id]):
+                session_id, _, _ = Export.create()
+                Export.execute(session_id, {}, 'generate')
+                Export.delete(session_id)
+
+    with set_company(Company(company_id)):
+        return {'declaration_export': _timed(export)}
+
+
+def run_scale(database, data, scale, date):
+    "Generate the data of the scale and time each hot path"
+    start = time.perf_counter()
+    invoice_ids = _run(database, generate, data, scale, date)
+    timings = {'generate': time.perf_counter() - start}
+    for values in data['companies']:
+        company_id = values['company']
+        durations = _run(
+            database, time_company, data, company_id, invoice_ids, date)
+        durations.update(_run(database, time_export, company_id, date))
+        for name, duration in durations.items():
+            timings[name] = timings.get(name, 0) + duration
+    return {
+        'scale': scale,
+        'companies': len(data['companies']),
+        'invoices': len(invoice_ids),
+        'timings': timings,
+        }
+
+
+def main(database, scales, output, companies=1, products=100,
+        config_file=None):
+    from trytond.pool import Pool
+    config.update_etc(config_file)
+    Pool(database).init()
+
+    year = dt.date.today().year - 1
+    data = _run(database, setup, companies, products)
+    _run(database, create_fiscalyears, data, year)
+    results = []
+    for month, scale in enumerate(scales, 1):
+        print("Scale %s" % scale, file=sys.stderr)
+        result = run_scale(database, data, scale, dt.date(year, month, 15))
+        results.append(result)
+        for name, duration in result['timings'].items():
+            print("  %s: %.3fs" % (name, duration), file=sys.stderr)
+    with open(output, 'w') as fp:
+        json.dump({
+                'date': dt.datetime.now().isoformat(),
+                'trytond': trytond_version,
+                'python': platform.python_version(),
+                'backend': config.get('database', 'uri').split(':')[0],
+                'results': results,
+                }, fp, indent=2)
+
+
+def run():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-c', '--config', dest='config_file',
+        help='the trytond config file')
+    parser.add_argument('-o', '--output', dest='output', required=True,
+        help='the JSON file to store the results')
+    parser.add_argument('--companies', dest='companies', type=int,
+        default=1, help='the number of companies')
+    parser.add_argument('--products', dest='products', type=int,
+        default=100, help='the number of products per company')
+    parser.add_argument('scales', nargs='*', type=int, default=DEFAULT_SCALES,
+        help='the number of moves of each scale')
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+    main(args.database, args.scales, args.output,
+        companies=args.companies, products=args.products,
+        config_file=args.config_file)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,11 +1,33 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 from decimal import Decimal
+from functools import wraps
+from weakref import WeakKeyDictionary
 
-from trytond.model import fields, ModelSQL
+from sql import Column, Literal, Null, Union
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Concat, Exists
+
+from trytond.model import fields, Index, ModelSQL, ModelStorage
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
-from trytond.transaction import Transaction, without_check_access
+from trytond import backend, config
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
+from trytond.transaction import (
+    Transaction, inactive_records, record_cache_size)
+
+logger = logging.getLogger(__name__)
+
+_batches = WeakKeyDictionary()
+_stats = WeakKeyDictionary()
+_no_stage = nullcontext()
 
 
 class Configuration(metaclass=PoolMeta):
@@ -14,6 +36,22 @@ class Configuration(metaclass=PoolMeta):
     intrastat_exempt_taxes = fields.Many2Many(
         'stock.configuration-account.tax', 'configuration', 'tax',
         "Intrastat Exempt Taxes")
+    _intrastat_exempt_taxes_cache = Cache(
+        'stock.configuration.intrastat_exempt_taxes', context=False)
+
+    @classmethod
+    def get_intrastat_exempt_tax_ids(cls):
+        "Return the set of the Intrastat exempt tax ids"
+        pool = Pool()
+        ConfigurationTax = pool.get('stock.configuration-account.tax')
+        tax_ids = cls._intrastat_exempt_taxes_cache.get(None)
+        if tax_ids is None:
+            table = ConfigurationTax.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.tax))
+            tax_ids = [t for t, in cursor]
+            cls._intrastat_exempt_taxes_cache.set(None, tax_ids)
+        return frozenset(tax_ids)
 
 
 class StockConfigurationAccountTax(ModelSQL):
@@ -30,18 +68,420 @@ class StockConfigurationAccountTax(ModelSQL):
             ],
         )
 
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Move = pool.get('stock.move')
+
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._intrastat_exempt_taxes_cache.clear()
+        # The moves taxed with an exempted tax may change their Intrastat
+        taxes = [r.tax.id for r in records]
+        domain = [('invoice_lines.taxes', 'in', taxes)]
+        try:
+            pool.get('sale.line')
+        except KeyError:
+            pass
+        else:
+            domain = ['OR', domain, ('origin.taxes', 'in', taxes, 'sale.line')]
+        Move.mark_intrastat_dirty(Move.search([
+                    domain,
+                    ('state', '=', 'done'),
+                    ], order=[]))
+
+
+class IntrastatBatch:
+    '''
+    Records and lookups shared by a batch of moves
+
+    While the batch is active, the Intrastat computation of its moves uses the
+    preloaded data instead of querying the database for each move.
+    '''
+
+    def __init__(self, moves):
+        self.moves = moves
+        self.move_ids = {m.id for m in moves}
+        self.exempt_moves = None
+        self.landed_cost_shipments = None
+        # The warehouse by location id
+        self.warehouses = None
+        # If the countries are in the Intrastat by country and arguments
+        self.intrastat_countries = {}
+        self.invoice_lines = None
+        # The tariff codes resolved by product and pattern
+        self.tariff_codes = {}
+        # The currency rates by currencies and date
+        self.currency_rates = {}
+        # The unit prices of the price lists by product, unit and date
+        self.price_list_prices = {}
+        self.price_list_quantity = {}
+        # The declarations of the dry runs by company, country and month
+        self.declarations = {}
+        self._previous = None
+
+    @classmethod
+    def get(cls):
+        "Return the batch active in the current transaction"
+        return _batches.get(Transaction())
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._previous = _batches.get(transaction)
+        _batches[transaction] = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        transaction = Transaction()
+        if self._previous is not None:
+            _batches[transaction] = self._previous
+        else:
+            _batches.pop(transaction, None)
+
+    @staticmethod
+    def _load(records, names):
+        '''
+        Read the fields names of the records and return the loaded records
+
+        The related records instantiated from the same read share their ids,
+        so reading a field on the first one reads it for all of them.
+        '''
+        loaded = []
+        for record in records:
+            if (not isinstance(record, ModelStorage)
+                    or record.id is None or record.id < 0):
+                continue
+            for name in names:
+                if name in record._fields:
+                    getattr(record, name)
+            loaded.append(record)
+        return loaded
+
+    def prefetch(self):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+
+        moves = self._load(self.moves, [
+                'shipment', 'origin', 'product', 'company', 'currency',
+                'invoice_lines', 'from_location', 'to_location'])
+        shipments = self._load([m.shipment for m in moves], [
+                'supplier', 'customer', 'intrastat_transport', 'price_list',
+                'from_location', 'to_location'])
+        locations = self._load(
+            [l for m in moves for l in (m.from_location, m.to_location)]
+            + [getattr(s, n, None) for s in shipments
+                for n in ['from_location', 'to_location']],
+            ['type', 'left', 'right'])
+        self.warehouses = Location.get_warehouse_by_location(locations)
+        warehouses = self._load(
+            [w for w in self.warehouses.values() if w], ['address'])
+        self._load([w.address for w in warehouses], ['country', 'subdivision'])
+        self._load(
+            [s.supplier for s in shipments if hasattr(s, 'supplier')]
+            + [s.customer for s in shipments if hasattr(s, 'customer')],
+            ['purchase_incoterms', 'sale_incoterms'])
+        origins = self._load([m.origin for m in moves], [
+                'sale', 'purchase'])
+        self._load(
+            [getattr(o, 'sale', getattr(o, 'purchase', None))
+                for o in origins],
+            ['incoterm'])
+        lines = self._load([l for m in moves for l in m.invoice_lines], [
+                'invoice', 'quantity', 'product'])
+        self._load([l.invoice for l in lines], [
+                'state', 'invoice_date', 'accounting_date', 'lines'])
+        products = self._load([m.product for m in moves], ['template'])
+        self._load([p.template for p in products], [
+                'tariff_codes_category', 'customs_category'])
+        self._load([m.company for m in moves], ['party', 'intrastat'])
+        self.exempt_moves = Move.intrastat_exempt_moves(moves)
+        self.landed_cost_shipments = Move.landed_cost_shipments(shipments)
+        self.invoice_lines = Move.intrastat_invoice_lines(moves)
+
+        products_by_pattern = defaultdict(set)
+        for move in moves:
+            if move.product:
+                pattern = move._intrastat_tariff_code_pattern_wo_country()
+                products_by_pattern[tuple(sorted(pattern.items()))].add(
+                    move.product)
+        for pattern, products in products_by_pattern.items():
+            Product.get_tariff_code_by_product(products, dict(pattern))
+
+        Move.compute_intrastat_price_list([
+                m for m in moves
+                if isinstance(m.shipment, ShipmentInternal)])
+        Move._intrastat_currency_rates([
+                (m.currency.id,
+                    (m.company.intrastat_currency or m.currency).id,
+                    m.effective_date or m.planned_date)
+                for m in moves if m.currency and m.company])
+
+
+class IntrastatStats:
+    '''
+    Timers and counters of the Intrastat computation
+
+    The statistics are collected when the context has _intrastat_stats or the
+    option stats of the section account_stock_eu_es of the configuration is
+    set, and they are logged at the end of each run. Otherwise the stages and
+    the counters are skipped.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        # The time, calls and queries by stage
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stage_queries = defaultdict(int)
+        self.counters = defaultdict(int)
+        # The hits and misses by lookup
+        self.lookups = defaultdict(lambda: [0, 0])
+        # None when the backend does not allow to count them
+        self.queries = None
+        self._caches = {}
+
+    @staticmethod
+    def enabled():
+        return bool(Transaction().context.get(
+                '_intrastat_stats',
+                config.getboolean(
+                    'account_stock_eu_es', 'stats', default=False)))
+
+    @classmethod
+    def get(cls):
+        "Return the statistics collected in the current transaction"
+        if _stats:
+            return _stats.get(Transaction())
+
+    @classmethod
+    @contextmanager
+    def collect(cls, name):
+        '''
+        Collect the statistics of the run and log them at the end
+
+        The runs nested in another one are added to it.
+        '''
+        stats = cls.get()
+        if stats is not None or not cls.enabled():
+            yield stats
+            return
+        transaction = Transaction()
+        stats = cls(name)
+        _stats[transaction] = stats
+        stats._caches = cls._cache_stats()
+        start = time.perf_counter()
+        try:
+            with stats._count_queries():
+                yield stats
+        finally:
+            duration = time.perf_counter() - start
+            _stats.pop(transaction, None)
+            stats.report(duration)
+
+    @classmethod
+    def stage(cls, name):
+        "Return a context manager that times the stage name"
+        stats = cls.get()
+        if stats is None:
+            return _no_stage
+        return stats._time(name)
+
+    @classmethod
+    def timed(cls, name):
+        "Decorate a function to time it as the stage name"
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                stats = cls.get()
+                if stats is None:
+                    return func(*args, **kwargs)
+                with stats._time(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def count(cls, name, value=1):
+        stats = cls.get()
+        if stats is not None:
+            stats.counters[name] += value
+
+    @classmethod
+    def lookup(cls, name, hit):
+        "Count a hit or a miss of the lookup name"
+        stats = cls.get()
+        if stats is not None:
+            stats.lookups[name][0 if hit else 1] += 1
+
+    @contextmanager
+    def _time(self, name):
+        queries = self.queries
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+            self.calls[name] += 1
+            if queries is not None:
+                self.stage_queries[name] += self.queries - queries
+
+    @contextmanager
+    def _count_queries(self):
+        "Count the queries executed on the connection of the transaction"
+        connection = Transaction().connection
+        if hasattr(connection, 'set_trace_callback'):
+            # SQLite calls the trace callback for each statement
+            sqlite_logger = logging.getLogger(
+                'trytond.backend.sqlite.database')
+            debug = sqlite_logger.isEnabledFor(logging.DEBUG)
+
+            def trace(statement):
+                self.queries += 1
+                if debug:
+                    sqlite_logger.debug(statement)
+            self.queries = 0
+            connection.set_trace_callback(trace)
+            try:
+                yield
+            finally:
+                connection.set_trace_callback(
+                    sqlite_logger.debug if debug else None)
+        elif hasattr(connection, 'cursor_factory'):
+            # The cursors of PostgreSQL are created by the factory
+            factory = connection.cursor_factory
+            stats = self
+
+            class Cursor(factory):
+                def execute(self, *args, **kwargs):
+                    stats.queries += 1
+                    return super().execute(*args, **kwargs)
+
+                def executemany(self, *args, **kwargs):
+                    stats.queries += 1
+                    return super().executemany(*args, **kwargs)
+            self.queries = 0
+            connection.cursor_factory = Cursor
+            try:
+                yield
+            finally:
+                connection.cursor_factory = factory
+        else:
+            yield
+
+    @staticmethod
+    def _cache_stats():
+        return {s['name']: (s['hit'], s['miss']) for s in Cache.stats()}
+
+    def report(self, duration):
+        "Log the statistics of the run"
+        lines = ["Intrastat %s statistics: %.3fs" % (self.name, duration)]
+        if self.queries is not None:
+            lines[0] += ", %s queries" % self.queries
+        for name, value in sorted(self.counters.items()):
+            lines.append("  %s: %s" % (name, value))
+        for name, timer in sorted(
+                self.timers.items(), key=lambda t: t[1], reverse=True):
+            line = "  stage %s: %.3fs, %s calls" % (
+                name, timer, self.calls[name])
+            if self.queries is not None:
+                line += ", %s queries" % self.stage_queries[name]
+            lines.append(line)
+        lookups = {
+            'lookup ' + name: (hit, miss)
+            for name, (hit, miss) in self.lookups.items()}
+        # The caches are shared by the threads so their ratio is approximate
+        for name, (hit, miss) in self._cache_stats().items():
+            old_hit, old_miss = self._caches.get(name, (0, 0))
+            if hit - old_hit or miss - old_miss:
+                lookups['cache ' + name] = (hit - old_hit, miss - old_miss)
+        for name, (hit, miss) in sorted(lookups.items()):
+            lines.append("  %s: %.1f%% hits (%s/%s)" % (
+                    name, 100 * hit / (hit + miss), hit, hit + miss))
+        logger.info('\n'.join(lines))
+
+
+class Location(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+
+    @property
+    def warehouse(self):
+        batch = IntrastatBatch.get()
+        if batch is not None and batch.warehouses is not None:
+            IntrastatStats.lookup('warehouses', self.id in batch.warehouses)
+            if self.id in batch.warehouses:
+                return batch.warehouses[self.id]
+        return super().warehouse
+
+    @classmethod
+    def get_warehouse_by_location(cls, locations):
+        "Return a dictionary with the warehouse of each location id"
+        locations = {l.id: l for l in locations}
+        if not locations:
+            return {}
+        # The same warehouses as the searches of the warehouse property
+        with inactive_records():
+            warehouses = cls.search([
+                    ('parent', 'parent_of', list(locations)),
+                    ('type', '=', 'warehouse'),
+                    ], order=[('left', 'DESC')])
+        return {
+            l.id: next((w for w in warehouses
+                    if w.left <= l.left and l.right <= w.right), None)
+            for l in locations.values()}
+
+
 class Move(metaclass=PoolMeta):
     __name__ = 'stock.move'
 
     intrastat_cancelled = fields.Boolean("Intrastat Cancelled")
+    intrastat_dirty = fields.Boolean(
+        "Intrastat Dirty", readonly=True,
+        help="Set when an input of the Intrastat changed after it was "
+        "computed.")
     shipment_price_list = fields.Function(fields.Many2One('product.price_list',
             "Price List"), 'get_shipment_price_list',
         searcher='search_shipment_price_list')
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.effective_date, Index.Range()),
+                    where=t.intrastat_dirty == Literal(True)),
+                # Used to select the moves of a period to update
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.state, Index.Equality(cardinality='low')),
+                    (t.effective_date, Index.Range())),
+                Index(
+                    t,
+                    (t.shipment, Index.Similarity(begin=True)),
+                    (t.effective_date, Index.Range()),
+                    where=t.state == 'done'),
+                })
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        # account_stock_landed_cost is an optional dependency
+        cls._intrastat_landed_cost = 'unit_landed_cost' in cls._fields
+
     @staticmethod
     def default_intrastat_cancelled():
         return False
 
+    @staticmethod
+    def default_intrastat_dirty():
+        return False
+
     def get_shipment_price_list(self, name):
         pool = Pool()
         ShipmentInternal = pool.get('stock.shipment.internal')
@@ -84,11 +524,17 @@ class Move(metaclass=PoolMeta):
 
     @fields.depends('company', '_parent_company.intrastat', 'shipment',
         'shipment_price_list', 'invoice_lines', 'origin')
+    @IntrastatStats.timed('type')
     def on_change_with_intrastat_type(self):
         pool = Pool()
+        Company = pool.get('company.company')
         ShipmentInternal = pool.get('stock.shipment.internal')
 
-        if (not self.company or not self.company.intrastat or (
+        if not self.company:
+            return
+        intrastat, company_country = Company.get_intrastat_country(
+            self.company)
+        if (not intrastat or (
                     self.shipment and isinstance(
                         self.shipment, ShipmentInternal)
                     and (not self.shipment_price_list
@@ -100,8 +546,6 @@ class Move(metaclass=PoolMeta):
         # come "from" or "to" Company country must to be included.
         from_country = self.intrastat_from_country
         to_country = self.intrastat_to_country
-        company_address = self.company.party.address_get(type='invoice')
-        company_country = company_address.country if company_address else None
         if from_country and to_country and company_country:
             if (from_country != company_country
                     and to_country != company_country):
@@ -118,25 +562,18 @@ class Move(metaclass=PoolMeta):
         'planned_date', 'company', '_parent_company.intrastat_currency',
         'shipment_price_list', 'invoice_lines', 'shipment',
         'product', '_parent_product.cost_price', 'unit')
+    @IntrastatStats.timed('value')
     def on_change_with_intrastat_value(self):
         pool = Pool()
         Move = pool.get('stock.move')
-        Currency = pool.get('currency.currency')
-        try:
-            LandedCost = pool.get('account.landed_cost')
-        except:
-            LandedCost = None
 
         if self.shipment_price_list:
             ndigits = self.__class__.intrastat_value.digits[1]
-            with Transaction().set_context(
-                    date=self.effective_date or self.planned_date):
-                unit_price = self.shipment_price_list.compute(
-                    self.product, self.quantity, self.unit)
-                if unit_price is not None:
-                    unit_price = round(unit_price * Decimal(
-                            str(self.quantity)), ndigits)
-                return unit_price
+            unit_price, = Move.compute_intrastat_price_list([self])
+            if unit_price is not None:
+                unit_price = round(unit_price * Decimal(
+                        str(self.quantity)), ndigits)
+            return unit_price
 
         ndigits = Move.intrastat_value.digits[1]
         default_intrastat_value = None
@@ -148,27 +585,31 @@ class Move(metaclass=PoolMeta):
         # TODO: Control correctly UoM
         quantity = sum(l.quantity for l in self.invoice_lines if l.quantity > 0)
 
-        landed_costs = None
+        landed_costs = False
         intrastat_value = Decimal('0.0')
         # If Landed cost is set on a shipment, the intrastat value must be
         # calculated without this extra amount on unit_price.
-        if LandedCost and self.shipment:
-            with without_check_access():
-                landed_costs = LandedCost.search([
-                        ('shipments','in',[self.shipment.id]),
-                ], limit=1)
+        if self._intrastat_landed_cost and self.shipment:
+            batch = IntrastatBatch.get()
+            if (batch and batch.landed_cost_shipments is not None
+                    and self.id in batch.move_ids):
+                IntrastatStats.lookup('landed costs', True)
+                landed_cost_shipments = batch.landed_cost_shipments
+            else:
+                IntrastatStats.lookup('landed costs', False)
+                landed_cost_shipments = Move.landed_cost_shipments(
+                    [self.shipment])
+            landed_costs = str(self.shipment) in landed_cost_shipments
             if landed_costs and self.unit_price is not None and self.currency:
+                # The landed cost is not set until it is posted
                 unit_landed_cost = getattr(
-                    self, 'unit_landed_cost', Decimal('0.0'))
+                    self, 'unit_landed_cost', None) or Decimal('0.0')
                 unit_price = self.unit_price - unit_landed_cost
                 ndigits = self.__class__.intrastat_value.digits[1]
-                with Transaction().set_context(
-                        date=self.effective_date or self.planned_date):
-                    intrastat_value = round(Currency.compute(
-                            self.currency,
-                            unit_price * Decimal(str(self.quantity)),
-                            self.company.intrastat_currency or self.currency,
-                            round=False), ndigits)
+                intrastat_value = round(self._intrastat_currency_compute(
+                        unit_price * Decimal(str(self.quantity)),
+                        self.company.intrastat_currency or self.currency),
+                    ndigits)
 
         if not landed_costs:
             intrastat_value = (super().on_change_with_intrastat_value()
@@ -177,17 +618,116 @@ class Move(metaclass=PoolMeta):
         if invoices and quantity == self.quantity:
             intrastat_value_from_invoice = Move._intrastat_value_from_invoices(
                 self, invoices, intrastat_value)
-            with Transaction().set_context(
-                    date=self.effective_date or self.planned_date):
-                intrastat_value_from_invoice = round(Currency.compute(
-                        self.currency,
-                        intrastat_value_from_invoice,
-                        self.company.intrastat_currency,
-                        round=False), ndigits)
+            intrastat_value_from_invoice = round(
+                self._intrastat_currency_compute(
+                    intrastat_value_from_invoice,
+                    self.company.intrastat_currency or self.currency),
+                ndigits)
 
         return (intrastat_value_from_invoice or intrastat_value
             or default_intrastat_value)
 
+    @classmethod
+    def compute_intrastat_price_list(cls, moves):
+        """
+        Return the unit prices of the shipment price list of the moves
+
+        The price list is computed once per product, unit, date and, only if
+        the price list has lines with a quantity, quantity. The prices are kept
+        for the batch.
+        """
+        batch = IntrastatBatch.get()
+        prices = batch.price_list_prices if batch else {}
+        with_quantity = batch.price_list_quantity if batch else {}
+        unit_prices = []
+        for move in moves:
+            price_list = move.shipment_price_list
+            if not price_list:
+                unit_prices.append(None)
+                continue
+            if price_list.id not in with_quantity:
+                with_quantity[price_list.id] = any(
+                    l.quantity is not None for l in price_list.lines)
+            date = move.effective_date or move.planned_date
+            key = (price_list.id,
+                move.product.id if move.product else None,
+                move.unit.id if move.unit else None,
+                date,
+                move.quantity if with_quantity[price_list.id] else None)
+            IntrastatStats.lookup('price list prices', key in prices)
+            if key not in prices:
+                with Transaction().set_context(date=date):
+                    prices[key] = price_list.compute(
+                        move.product, move.quantity, move.unit)
+            unit_prices.append(prices[key])
+        return unit_prices
+
+    def _intrastat_currency_compute(self, amount, to_currency):
+        "Convert the amount from the currency of the move without rounding"
+        amount, = self.compute_intrastat_currency([(
+                    self.currency, amount, to_currency,
+                    self.effective_date or self.planned_date)])
+        return amount
+
+    @classmethod
+    def compute_intrastat_currency(cls, values):
+        """
+        Convert the amounts of the values like Currency.compute without
+        rounding
+
+        The values are tuples of the currency, the amount, the currency to
+        convert to and the date of the rate. The rates are resolved once per
+        currencies and date and kept for the batch.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        values = [(int(f), a, int(t), d) for f, a, t, d in values]
+        rates = cls._intrastat_currency_rates(
+            (f, t, d) for f, _, t, d in values)
+        amounts = []
+        for from_id, amount, to_id, date in values:
+            if from_id == to_id:
+                amounts.append(amount)
+                continue
+            from_rate, to_rate = rates[(from_id, to_id, date)]
+            if not from_rate or not to_rate:
+                # Raise the same error as Currency.compute
+                with Transaction().set_context(date=date):
+                    Currency.compute(from_id, amount, to_id, round=False)
+            amounts.append(amount * to_rate / from_rate)
+        return amounts
+
+    @classmethod
+    def _intrastat_currency_rates(cls, keys):
+        """
+        Return the rates of the currencies for the keys
+
+        The keys are tuples of the currency id, the currency id to convert to
+        and the date.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        batch = IntrastatBatch.get()
+        rates = batch.currency_rates if batch else {}
+        missing = defaultdict(set)
+        for from_id, to_id, date in keys:
+            if from_id != to_id:
+                hit = (from_id, to_id, date) in rates
+                IntrastatStats.lookup('currency rates', hit)
+                if not hit:
+                    missing[date].add((from_id, to_id))
+        for date, pairs in missing.items():
+            currency_ids = {c for p in pairs for c in p}
+            with Transaction().set_context(date=date):
+                currency_rates = {
+                    c.id: c.rate for c in Currency.browse(list(currency_ids))}
+            for from_id, to_id in pairs:
+                rates[(from_id, to_id, date)] = (
+                    currency_rates[from_id], currency_rates[to_id])
+        return rates
+
     def _set_intrastat(self):
         pool = Pool()
         try:
@@ -213,17 +753,18 @@ class Move(metaclass=PoolMeta):
         # Some times is possible that user change or remove the tariff_code in
         # some products after some moves of this productes are done. So, when
         # update some moves Intrastat values is need to reset the tariff_code.
-        if Transaction().context.get('_update_intrastat_declaration'):
-            intrastat_tariff_code = self.product.get_tariff_code(
-                self._intrastat_tariff_code_pattern())
-            if not intrastat_tariff_code:
+        with IntrastatStats.stage('tariff code'):
+            if Transaction().context.get('_update_intrastat_declaration'):
                 intrastat_tariff_code = self.product.get_tariff_code(
+                    self._intrastat_tariff_code_pattern())
+                if not intrastat_tariff_code:
+                    intrastat_tariff_code = self.product.get_tariff_code(
+                        self._intrastat_tariff_code_pattern_wo_country())
+                if intrastat_tariff_code != self.intrastat_tariff_code:
+                    self.intrastat_tariff_code = intrastat_tariff_code
+            elif not self.intrastat_tariff_code:
+                self.intrastat_tariff_code = self.product.get_tariff_code(
                     self._intrastat_tariff_code_pattern_wo_country())
-            if intrastat_tariff_code != self.intrastat_tariff_code:
-                self.intrastat_tariff_code = intrastat_tariff_code
-        elif not self.intrastat_tariff_code:
-            self.intrastat_tariff_code = self.product.get_tariff_code(
-                self._intrastat_tariff_code_pattern_wo_country())
         if (not self.intrastat_additional_unit
                 and self.intrastat_tariff_code
                 and self.intrastat_tariff_code.intrastat_uom):
@@ -237,24 +778,27 @@ class Move(metaclass=PoolMeta):
                 and self.shipment.intrastat_transport):
             self.intrastat_transport = self.shipment.intrastat_transport
 
-        if not self.intrastat_incoterm:
-            # Try to set Incoterm from origin
-            if self.origin:
-                if SaleLine and isinstance(self.origin, SaleLine):
-                    self.intrastat_incoterm = self.origin.sale.incoterm or None
-                elif PurchaseLine and isinstance(self.origin, PurchaseLine):
-                    self.intrastat_incoterm = (self.origin.purchase.incoterm
-                        or None)
-        if not self.intrastat_incoterm:
-            # Try to set Incoterm from party
-            shipment = self.shipment
-            party_incoterms = []
-            if isinstance(shipment, (ShipmentIn, ShipmentInReturn)):
-                party_incoterms = shipment.supplier.purchase_incoterms
-            if isinstance(shipment, (ShipmentOut, ShipmentOutReturn)):
-                party_incoterms = shipment.customer.sale_incoterms
-            if party_incoterms and len(party_incoterms) == 1:
-                self.intrastat_incoterm = party_incoterms[0].incoterm
+        with IntrastatStats.stage('incoterm'):
+            if not self.intrastat_incoterm:
+                # Try to set Incoterm from origin
+                if self.origin:
+                    if SaleLine and isinstance(self.origin, SaleLine):
+                        self.intrastat_incoterm = (self.origin.sale.incoterm
+                            or None)
+                    elif (PurchaseLine
+                            and isinstance(self.origin, PurchaseLine)):
+                        self.intrastat_incoterm = (
+                            self.origin.purchase.incoterm or None)
+            if not self.intrastat_incoterm:
+                # Try to set Incoterm from party
+                shipment = self.shipment
+                party_incoterms = []
+                if isinstance(shipment, (ShipmentIn, ShipmentInReturn)):
+                    party_incoterms = shipment.supplier.purchase_incoterms
+                if isinstance(shipment, (ShipmentOut, ShipmentOutReturn)):
+                    party_incoterms = shipment.customer.sale_incoterms
+                if party_incoterms and len(party_incoterms) == 1:
+                    self.intrastat_incoterm = party_incoterms[0].incoterm
 
         # If the move came from an Internal move, the subdivision maybe is
         # not set.
@@ -273,21 +817,13 @@ class Move(metaclass=PoolMeta):
         # If for some reason the intrastat_transport is not setted, we asume
         # it's Road transport, code 3.
         if not self.intrastat_transport and self.intrastat_type:
-            transports = Transport.search([
-                    ('code', '=', '3')
-                ], limit=1)
-            transport = transports[0] if transports else None
-            self.intrastat_transport = transport
+            self.intrastat_transport = Transport.get('3')
 
         # For Internal shipments with price_list, set a default Incoterm
         if (not self.intrastat_incoterm and self.intrastat_type
                 and isinstance(self.shipment, ShipmentInternal)
                 and self.shipment_price_list):
-            incoterms = Incoterm.search([
-                    ('code', '=', 'EXW')
-                ], order=[('id', 'DESC')], limit=1)
-            incoterm = incoterms[0] if incoterms else None
-            self.intrastat_incoterm = incoterm
+            self.intrastat_incoterm = Incoterm.get('EXW')
 
     def _intrastat_tariff_code_pattern_wo_country(self):
         return {
@@ -298,32 +834,79 @@ class Move(metaclass=PoolMeta):
     def _intrastat_value_from_invoices(cls, move, invoices, intrastat_value):
         pool = Pool()
         Invoice = pool.get('account.invoice')
-        InvoiceLine = pool.get('account.invoice.line')
-
-        lines_discounts = Invoice.get_invoice_intrastat_discount_per_line(
-            invoices)
 
+        batch = IntrastatBatch.get()
+        if (batch and batch.invoice_lines is not None
+                and move.id in batch.move_ids):
+            lines = batch.invoice_lines.get(move.id, [])
+        else:
+            lines = [(l.id, l.invoice.id, l.intrastat_amount,
+                    (l.invoice.accounting_date
+                        or l.invoice.invoice_date).replace(day=1))
+                for l in move.invoice_lines
+                if l.invoice and (l.invoice.accounting_date
+                    or l.invoice.invoice_date)]
+        invoice_ids = {i.id for i in invoices}
+        lines = [l for l in lines if l[1] in invoice_ids]
+        # The lines of invoices posted before the amount was stored
+        missing = {i for _, i, a, _ in lines if a is None}
+        lines_discounts = {}
+        if missing:
+            lines_discounts = {l.id: a for l, a in
+                Invoice.get_invoice_intrastat_discount_per_line(
+                    Invoice.browse(missing)).items()}
+
+        move_date = move.effective_date or move.planned_date
+        move_date = move_date.replace(day=1)
         value = 0
-        for line, amount in lines_discounts.items():
-            if move not in line.stock_moves:
-                continue
-            # Ensure that cache only take this 'line' an not 1.000
-            # registers. Beacsue in some cases the line may don't have and
-            # ivoice assocaited yet and it's needed for the company_amount
-            # field calculation.
-            line = InvoiceLine(line)
-            invoice_date = (line.invoice.accounting_date
-                or line.invoice.invoice_date)
-            invoice_date = invoice_date.replace(day=1)
-
-            move_date = move.effective_date or move.planned_date
-            move_date = move_date.replace(day=1)
-            if move_date != invoice_date:
+        for line_id, _, amount, invoice_month in lines:
+            if amount is None:
+                amount = lines_discounts.get(line_id, Decimal(0))
+            if move_date != invoice_month:
                 continue
             # Amount arrive with the sign setted in the line.
             value += amount
         return value
 
+    @classmethod
+    def intrastat_invoice_lines(cls, moves):
+        """
+        Return a dictionary with the invoice lines of each move id
+
+        The lines are tuples of the line id, the invoice id, the Intrastat
+        amount of the line and the accounting month of the invoice.
+        """
+        pool = Pool()
+        InvoiceLineMove = pool.get('account.invoice.line-stock.move')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        line_move = InvoiceLineMove.__table__()
+        line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        lines = defaultdict(list)
+        for sub_ids in grouped_slice(
+                [m.id for m in moves], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line_move.join(line,
+                    condition=line.id == line_move.invoice_line
+                    ).join(invoice,
+                    condition=invoice.id == line.invoice
+                    ).select(
+                    line_move.stock_move, line.id, invoice.id,
+                    line.intrastat_amount, invoice.accounting_date,
+                    invoice.invoice_date,
+                    where=fields.SQL_OPERATORS['in'](
+                        line_move.stock_move, sub_ids)))
+            for (move_id, line_id, invoice_id, amount, accounting_date,
+                    invoice_date) in cursor:
+                date = accounting_date or invoice_date
+                if not date:
+                    continue
+                lines[move_id].append(
+                    (line_id, invoice_id, amount, date.replace(day=1)))
+        return lines
+
     def _intrastat_quantity(self, unit):
         pool = Pool()
         UoM = pool.get('product.uom')
@@ -360,51 +943,220 @@ class Move(metaclass=PoolMeta):
 
     @classmethod
     def update_intrastat_declaration(cls, moves):
+        """
+        Update the Intrastat of the moves
+
+        Return the number of moves changed and left unchanged. The
+        declarations left empty are only deleted by the update wizard.
+        """
+        return cls._update_intrastat_moves(moves)
+
+    @classmethod
+    def update_intrastat_dirty(cls, moves):
+        """
+        Update the Intrastat of the moves that are still flagged
+
+        The moves already updated since they were flagged are skipped, so the
+        tasks queued for the same moves do the work only once.
+        """
+        moves = cls.search([
+                ('id', 'in', [m.id for m in moves]),
+                ('intrastat_dirty', '=', True),
+                ], order=[('id', 'ASC')])
+        return cls.update_intrastat_declaration(moves)
+
+    @classmethod
+    def _update_intrastat_moves(cls, moves):
+        transaction = Transaction()
+        changed = unchanged = 0
+        with IntrastatStats.collect('update'), \
+                transaction.set_context(_update_intrastat_declaration=True):
+            # Browse each batch as a single list so the related records are
+            # read once per batch instead of once per move.
+            for sub_moves in grouped_slice(
+                    moves, record_cache_size(transaction)):
+                with IntrastatBatch(cls.browse(sub_moves)) as batch:
+                    with IntrastatStats.stage('prefetch'):
+                        batch.prefetch()
+                    sub_changed, sub_unchanged = cls._update_intrastat_batch(
+                        batch)
+                changed += sub_changed
+                unchanged += sub_unchanged
+            IntrastatStats.count('moves changed', changed)
+            IntrastatStats.count('moves unchanged', unchanged)
+        return changed, unchanged
+
+    @classmethod
+    def delete_orphan_intrastat_declarations(cls, declarations):
+        "Delete the declarations that have no more moves"
         pool = Pool()
         IntrastatDeclaration = pool.get(
             'account.stock.eu.intrastat.declaration')
+        declaration = IntrastatDeclaration.__table__()
+        move = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        with IntrastatStats.stage('delete orphans'):
+            orphan_ids = []
+            for sub_ids in grouped_slice(
+                    {int(d) for d in declarations}, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*declaration.select(declaration.id,
+                        where=fields.SQL_OPERATORS['in'](
+                            declaration.id, sub_ids)
+                        & ~Exists(move.select(Literal(1),
+                                where=move.intrastat_declaration
+                                == declaration.id))))
+                orphan_ids.extend(d for d, in cursor)
+            if orphan_ids:
+                IntrastatDeclaration.delete(
+                    IntrastatDeclaration.browse(orphan_ids))
+
+    @classmethod
+    def diff_intrastat_declaration(cls, moves):
+        """
+        Return the changes the update would make to the Intrastat of the moves
+        without writing anything
+
+        The result is a dictionary with the number of changed moves, the
+        number of changes per field, the value delta per declaration and the
+        moves that would leave the Intrastat.
+        """
+        transaction = Transaction()
+        changed = 0
+        field_changes = defaultdict(int)
+        declaration_deltas = defaultdict(Decimal)
+        dropped = []
+
+        def declaration_key(declaration):
+            # The declarations to create are not saved so they have no id
+            return (declaration.rec_name, declaration.company.id,
+                declaration.country.id, declaration.month)
+
+        reset_values = cls._reset_intrastat_values()
+        with IntrastatStats.collect('diff'), transaction.set_context(
+                _update_intrastat_declaration=True,
+                _intrastat_dry_run=True,
+                _skip_warnings=True):
+            for sub_moves in grouped_slice(
+                    moves, record_cache_size(transaction)):
+                with IntrastatBatch(cls.browse(sub_moves)) as batch:
+                    with IntrastatStats.stage('prefetch'):
+                        batch.prefetch()
+                    moves_to_reset, moves_to_save, stored = (
+                        cls._compute_intrastat_batch(batch))
+                    new = {}
+                    for move in moves_to_reset:
+                        new[move] = reset_values
+                    for move in moves_to_save:
+                        new[move] = move._intrastat_stored_values()
+                    for move, values in new.items():
+                        old = stored[move.id]
+                        changed += 1
+                        for name, value in values.items():
+                            if value != old[name]:
+                                field_changes[name] += 1
+                        if (old['intrastat_type']
+                                and not values['intrastat_type']):
+                            dropped.append(move)
+                        # The value leaves the old declaration and is added
+                        # to the new one
+                        for sign, side in [(-1, old), (1, values)]:
+                            declaration = side['intrastat_declaration']
+                            if side['intrastat_type'] and declaration:
+                                declaration_deltas[
+                                    declaration_key(declaration)] += (
+                                    sign * (side['intrastat_value'] or 0))
+        return {
+            'changed': changed,
+            'unchanged': len(moves) - changed,
+            'fields': dict(field_changes),
+            'declarations': {
+                k: v for k, v in declaration_deltas.items() if v},
+            'dropped': dropped,
+            }
+
+    @classmethod
+    def _update_intrastat_batch(cls, batch):
+        moves_to_reset, moves_to_save, _ = cls._compute_intrastat_batch(batch)
+        with IntrastatStats.stage('save'):
+            cls.reset_intrastat(moves_to_reset)
+            cls.save(moves_to_save)
+        IntrastatStats.count('moves reset', len(moves_to_reset))
+        IntrastatStats.count('moves saved', len(moves_to_save))
+        changed = len(moves_to_reset) + len(moves_to_save)
+        return changed, len(batch.moves) - changed
+
+    @classmethod
+    def _compute_intrastat_batch(cls, batch):
+        """
+        Compute in memory the Intrastat of the moves of the batch
+
+        Return the moves to reset, the moves to save and the Intrastat values
+        stored of each move id.
+        """
+        pool = Pool()
         ShipmentIn = pool.get('stock.shipment.in')
         ShipmentOutReturn = pool.get('stock.shipment.out.return')
-        declarations = {
-            move.intrastat_declaration for move in moves
-            if move.intrastat_declaration}
-
-        with Transaction().set_context(_update_intrastat_declaration=True):
-            moves_to_reset = []
-            for move in moves:
-                if move.intrastat_cancelled or move.move_tax_intrastat_exempt():
+
+        moves = batch.moves
+        reopen_cancelled = Transaction().context.get(
+            '_intrastat_reopen_cancelled')
+        moves_to_reset, moves_to_save, stored_values = [], [], {}
+        for move in moves:
+            # Only the moves not yet reset are written
+            reset_needed = move._intrastat_reset_needed()
+            stored = stored_values[move.id] = (
+                move._intrastat_stored_values())
+            if reopen_cancelled and move.intrastat_cancelled:
+                move.intrastat_cancelled = False
+            if move.intrastat_cancelled or move.move_tax_intrastat_exempt():
+                if reset_needed:
                     moves_to_reset.append(move)
-                    continue
-                if move.shipment and isinstance(move.shipment, ShipmentIn):
-                    move.shipment.on_change_supplier()
-                elif (move.shipment
-                        and isinstance(move.shipment, ShipmentOutReturn)):
-                    move.shipment.on_change_customer()
-                move.intrastat_type = move.on_change_with_intrastat_type()
-                if not move.intrastat_type:
+                continue
+            if move.shipment and isinstance(move.shipment, ShipmentIn):
+                move.shipment.on_change_supplier()
+            elif (move.shipment
+                    and isinstance(move.shipment, ShipmentOutReturn)):
+                move.shipment.on_change_customer()
+            move.intrastat_type = move.on_change_with_intrastat_type()
+            if not move.intrastat_type:
+                if reset_needed:
                     moves_to_reset.append(move)
-                    continue
+                continue
+            with IntrastatStats.stage('set'):
                 move._set_intrastat()
-                if not move.internal_weight:
+            if not move.internal_weight:
+                with IntrastatStats.stage('weight'):
                     internal_weight = move.on_change_with_internal_weight()
-                    move.internal_weight = internal_weight or 0
-            if moves_to_reset:
-                cls.reset_intrastat(moves_to_reset)
-            cls.save(moves)
-        if declarations:
-            remaining_moves = cls.search([
-                    ('intrastat_declaration', 'in', list(declarations)),
-                    ])
-            remaining_declarations = {
-                move.intrastat_declaration for move in remaining_moves
-                if move.intrastat_declaration}
-            orphan_declarations = list(declarations - remaining_declarations)
-            if orphan_declarations:
-                IntrastatDeclaration.delete(orphan_declarations)
+                move.internal_weight = internal_weight or 0
+            if move.intrastat_dirty:
+                move.intrastat_dirty = False
+            # Only the moves with a different Intrastat are written
+            if any(name not in stored or getattr(move, name) != stored[name]
+                    for name in move._values._keys()):
+                moves_to_save.append(move)
+        return moves_to_reset, moves_to_save, stored_values
+
+    def _intrastat_stored_values(self):
+        "Return the Intrastat values of the move before the update"
+        return {
+            name: getattr(self, name)
+            for name in self._reset_intrastat_values()}
+
+    def _intrastat_reset_needed(self):
+        "Return if the Intrastat of the move differs from a reset one"
+        for name, value in self._reset_intrastat_values().items():
+            # The values computed on write are kept by the reset moves
+            if name in {
+                    'intrastat_value', 'internal_weight', 'internal_volume'}:
+                continue
+            if getattr(self, name) != value:
+                return True
+        return False
 
     @classmethod
-    def reset_intrastat(cls, moves):
-        values = {
+    def _reset_intrastat_values(cls):
+        return {
             'internal_volume': None,
             'internal_weight': None,
             'intrastat_additional_unit': None,
@@ -421,29 +1173,164 @@ class Move(metaclass=PoolMeta):
             'intrastat_incoterm': None,
             'intrastat_transport': None,
             'intrastat_cancelled': True,
+            'intrastat_dirty': False,
             }
-        cls.write(moves, values)
 
+    @classmethod
+    def reset_intrastat(cls, moves):
+        """
+        Clear the Intrastat of the moves
+
+        The columns are cleared with one UPDATE per slice of ids instead of an
+        ORM write, the declarations are reopened and the computed fields are
+        updated as the write would do.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        ids = [m.id for m in moves]
+        if not ids:
+            return
+        values = cls._reset_intrastat_values()
+        # Reopen the declarations before the moves are removed from them
+        cls._reopen_intrastat(cls.browse(ids))
+        columns = [Column(table, name) for name in values]
+        columns += [table.write_date, table.write_uid]
+        update_values = list(values.values())
+        update_values += [CurrentTimestamp(), transaction.user]
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.update(columns, update_values,
+                    where=fields.SQL_OPERATORS['in'](table.id, sub_ids)))
+        cls._clear_transaction_cache(ids)
+        cls._insert_history(ids)
+        for sub_ids in grouped_slice(ids, record_cache_size(transaction)):
+            cls._compute_fields(cls.browse(sub_ids), field_names=set(values))
+
+    @classmethod
+    def mark_intrastat_dirty(cls, moves):
+        "Flag the done moves to be processed by the incremental update"
+        move = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = list(map(int, moves))
+        for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*move.update(
+                    [move.intrastat_dirty], [True],
+                    where=fields.SQL_OPERATORS['in'](move.id, sub_ids)
+                    & (move.state == 'done')
+                    & ((move.intrastat_dirty == Literal(False))
+                        | (move.intrastat_dirty == Null))))
+        cls._clear_transaction_cache(ids)
+
+    @classmethod
+    def _clear_transaction_cache(cls, ids):
+        "Forget the cached values of the moves updated with SQL"
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                cache_cls = cache[cls.__name__]
+                for id_ in ids:
+                    cache_cls.pop(id_, None)
+
+    @IntrastatStats.timed('exempt')
     def move_tax_intrastat_exempt(self):
         pool = Pool()
         Configuration = pool.get('stock.configuration')
 
-        config = Configuration(1)
-        if not config.intrastat_exempt_taxes:
+        batch = IntrastatBatch.get()
+        if (batch and batch.exempt_moves is not None
+                and self.id in batch.move_ids):
+            IntrastatStats.lookup('exempt moves', True)
+            return self.id in batch.exempt_moves
+        IntrastatStats.lookup('exempt moves', False)
+        tax_ids = Configuration.get_intrastat_exempt_tax_ids()
+        if not tax_ids:
             return False
         for line in self.invoice_lines:
             for tax in line.taxes:
-                if tax in config.intrastat_exempt_taxes:
+                if tax.id in tax_ids:
                     return True
         if hasattr(self, 'sale'):
             SaleLine = pool.get('sale.line')
             sale_line_taxes = (self.origin.taxes
                 if isinstance(self.origin, SaleLine) else [])
             for tax in sale_line_taxes:
-                if tax in config.intrastat_exempt_taxes:
+                if tax.id in tax_ids:
                     return True
         return False
 
+    @classmethod
+    def landed_cost_shipments(cls, shipments):
+        """
+        Return the set of the shipments with a landed cost as strings of
+        model and id
+
+        Only the supplier shipments can have a landed cost, so the other
+        shipments with the same id are not included.
+        """
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        if not cls._intrastat_landed_cost:
+            return set()
+        ShipmentIn = pool.get('stock.shipment.in')
+        LandedCostShipment = pool.get('account.landed_cost-stock.shipment.in')
+        table = LandedCostShipment.__table__()
+        shipment_ids = {
+            s.id for s in shipments if isinstance(s, ShipmentIn)}
+        landed_shipments = set()
+        for sub_ids in grouped_slice(shipment_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(table.shipment,
+                    where=fields.SQL_OPERATORS['in'](table.shipment, sub_ids),
+                    group_by=table.shipment))
+            landed_shipments.update(str(ShipmentIn(s)) for s, in cursor)
+        return landed_shipments
+
+    @classmethod
+    def intrastat_exempt_moves(cls, moves):
+        "Return the set of ids of the moves taxed with an exempt tax"
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        InvoiceLineMove = pool.get('account.invoice.line-stock.move')
+        InvoiceLineTax = pool.get('account.invoice.line-account.tax')
+        ConfigurationTax = pool.get('stock.configuration-account.tax')
+        cursor = Transaction().connection.cursor()
+
+        if not Configuration.get_intrastat_exempt_tax_ids():
+            return set()
+        move = cls.__table__()
+        line_move = InvoiceLineMove.__table__()
+        line_tax = InvoiceLineTax.__table__()
+        exempt_tax = ConfigurationTax.__table__()
+        if hasattr(cls, 'sale'):
+            SaleLineTax = pool.get('sale.line-account.tax')
+            sale_line_tax = SaleLineTax.__table__()
+
+        exempt = set()
+        for sub_ids in grouped_slice(
+                [m.id for m in moves], backend.MAX_QUERY_PARAMS):
+            query = line_move.join(line_tax,
+                condition=line_tax.line == line_move.invoice_line
+                ).join(exempt_tax,
+                condition=exempt_tax.tax == line_tax.tax
+                ).select(line_move.stock_move.as_('move'),
+                where=fields.SQL_OPERATORS['in'](
+                    line_move.stock_move, sub_ids))
+            if hasattr(cls, 'sale'):
+                query = Union(query, move.join(sale_line_tax,
+                        condition=sale_line_tax.line == cls.origin.sql_id(
+                            move.origin, cls)
+                        ).join(exempt_tax,
+                        condition=exempt_tax.tax == sale_line_tax.tax
+                        ).select(move.id.as_('move'),
+                        where=fields.SQL_OPERATORS['in'](move.id, sub_ids)
+                        & move.origin.like('sale.line,%')))
+            cursor.execute(*query)
+            exempt.update(m for m, in cursor)
+        return exempt
+
     @classmethod
     def do(cls, moves):
         pool = Pool()
@@ -463,6 +1350,7 @@ class Move(metaclass=PoolMeta):
     def copy(cls, moves, default=None):
         default = default.copy() if default else {}
         default.setdefault('intrastat_cancelled')
+        default.setdefault('intrastat_dirty', False)
         return super().copy(moves, default=default)
 
 
@@ -473,16 +1361,74 @@ class ShipmentMixin:
         'account.stock.eu.intrastat.transport', "Intrastat Transport",
         ondelete='RESTRICT')
     total_intrastat_value = fields.Function(fields.Numeric(
-            "Total Intrastat Value", digits=(16, 2), readonly=True),
-        'get_total_intrastat_value')
+            "Total Intrastat Value", digits=(None, 2), readonly=True),
+        'get_total_intrastat_value', searcher='search_total_intrastat_value')
 
-    def get_total_intrastat_value(self, name):
-        total = Decimal(0)
-        for move in self.moves:
-            if not move.intrastat_type or not move.intrastat_value:
-                continue
-            total += move.intrastat_value
-        return total
+    @classmethod
+    def _total_intrastat_value_query(cls, shipment_ids=None):
+        """
+        Return the query of the total Intrastat value per shipment id
+
+        The Intrastat values of the moves are summed in one aggregate query
+        instead of loading the moves of each shipment.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        move = Move.__table__()
+
+        where = Literal(True)
+        if shipment_ids is not None:
+            where = fields.SQL_OPERATORS['in'](table.id, shipment_ids)
+        return (table
+            .join(move, 'LEFT',
+                condition=(
+                    Concat(cls.__name__ + ',', table.id) == move.shipment)
+                & (move.intrastat_type != Null))
+            .select(
+                table.id.as_('id'),
+                Coalesce(Sum(move.intrastat_value), 0).as_(
+                    'total_intrastat_value'),
+                where=where,
+                group_by=[table.id]))
+
+    @classmethod
+    def get_total_intrastat_value(cls, shipments, name):
+        cursor = Transaction().connection.cursor()
+        digits = cls.total_intrastat_value.digits[1]
+
+        totals = {}
+        for sub_ids in grouped_slice(
+                list(map(int, shipments)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*cls._total_intrastat_value_query(sub_ids))
+            for shipment_id, total in cursor:
+                # SQLite returns the sum as a float
+                if not isinstance(total, Decimal):
+                    total = Decimal(str(total))
+                totals[shipment_id] = round(total, digits)
+        return totals
+
+    @classmethod
+    def search_total_intrastat_value(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = cls._total_intrastat_value_query()
+        return [('id', 'in', query.select(
+                    query.id,
+                    where=Operator(query.total_intrastat_value, value)))]
+
+    @classmethod
+    def order_total_intrastat_value(cls, tables):
+        table, _ = tables[None]
+        total = tables.get('total_intrastat_value')
+        if total is None:
+            total = cls._total_intrastat_value_query()
+            tables['total_intrastat_value'] = {
+                None: (total, total.id == table.id),
+                }
+        else:
+            total, _ = total[None]
+        return [total.total_intrastat_value]
 
 
 class ShipmentIn(ShipmentMixin, metaclass=PoolMeta):
@@ -532,6 +1478,16 @@ class ShipmentInternal(ShipmentMixin, metaclass=PoolMeta):
     currency = fields.Function(fields.Many2One('currency.currency',
         'Currency'), 'on_change_with_currency')
 
+    @classmethod
+    def on_modification(cls, mode, shipments, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        super().on_modification(mode, shipments, field_names=field_names)
+        if mode == 'write' and 'price_list' in field_names:
+            Move.mark_intrastat_dirty(
+                [m for s in shipments for m in s.moves])
+
     @fields.depends('to_location')
     def on_change_with_to_warehouse(self, name=None):
         return self.to_location.warehouse if self.to_location else None
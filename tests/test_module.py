@@ -1,7 +1,27 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime as dt
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+from io import BytesIO
+from zipfile import ZipFile
+
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.account_stock_eu_es.stock import IntrastatStats
+from trytond.modules.company.tests import create_company, set_company
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+@contextmanager
+def count_queries():
+    "Count the queries executed in the block"
+    with Transaction().set_context(_intrastat_stats=True), \
+            IntrastatStats.collect('queries') as stats:
+        yield stats
 
 
 class AccountStockEuTestCase(ModuleTestCase):
@@ -22,5 +42,681 @@ class AccountStockEuTestCase(ModuleTestCase):
         self.assertIn('name="invoice_lines"', arch)
         self.assertIn('tree_invisible="1"', arch)
 
+    @with_transaction()
+    def test_company_intrastat_country(self):
+        "Test company Intrastat country follows its addresses"
+        pool = Pool()
+        Address = pool.get('party.address')
+        Company = pool.get('company.company')
+        Country = pool.get('country.country')
+
+        belgium, france = Country.create([
+                {'name': "Belgium", 'code': 'BE'},
+                {'name': "France", 'code': 'FR'},
+                ])
+        company = create_company()
+        with set_company(company):
+            self.assertEqual(
+                Company.get_intrastat_country(company), (True, None))
+
+            address, = company.party.addresses
+            address.country = belgium
+            address.save()
+            self.assertEqual(
+                Company.get_intrastat_country(company), (True, belgium))
+
+            invoice_address, = Address.create([{
+                        'party': company.party.id,
+                        'country': france.id,
+                        'invoice': True,
+                        }])
+            self.assertEqual(
+                Company.get_intrastat_country(company), (True, france))
+
+            Address.delete([invoice_address])
+            company.intrastat = False
+            company.save()
+            self.assertEqual(
+                Company.get_intrastat_country(company), (False, belgium))
+
+    @with_transaction()
+    def test_configuration_intrastat_update_delay(self):
+        "Test the Intrastat update delay follows the configuration"
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+
+        company = create_company()
+        with set_company(company):
+            self.assertIsNone(Configuration.get_intrastat_update_delay())
+
+            configuration = Configuration(1)
+            configuration.intrastat_update_delay = dt.timedelta(minutes=5)
+            configuration.save()
+            self.assertEqual(
+                Configuration.get_intrastat_update_delay(),
+                dt.timedelta(minutes=5))
+
+    @with_transaction()
+    def test_product_tariff_code_by_product(self):
+        "Test the tariff codes of many products are resolved like each one"
+        pool = Pool()
+        Category = pool.get('product.category')
+        Product = pool.get('product.product')
+        TariffCode = pool.get('customs.tariff.code')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        desk_code, chair_code = TariffCode.create([
+                {'code': '9403 10 51'},
+                {'code': '9401 71 00'},
+                ])
+        parent, = Category.create([{
+                    'name': "Furniture",
+                    'customs': True,
+                    'tariff_codes': [('create', [{
+                                    'tariff_code': chair_code.id,
+                                    }])],
+                    }])
+        child, = Category.create([{
+                    'name': "Chairs",
+                    'customs': True,
+                    'parent': parent.id,
+                    'tariff_codes_parent': True,
+                    }])
+        templates = Template.create([{
+                    'name': "Desk",
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'tariff_codes': [('create', [{
+                                    'tariff_code': desk_code.id,
+                                    }])],
+                    'products': [('create', [{}])],
+                    }, {
+                    'name': "Chair",
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'customs_category': child.id,
+                    'tariff_codes_category': True,
+                    'products': [('create', [{}])],
+                    }, {
+                    'name': "Lamp",
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'products': [('create', [{}])],
+                    }])
+        products = [p for t in templates for p in t.products]
+        pattern = {'date': dt.date.today()}
+
+        self.assertEqual(
+            Product.get_tariff_code_by_product(products, pattern),
+            {p.id: p.get_tariff_code(pattern) for p in products})
+        self.assertEqual(
+            [p.get_tariff_code(pattern) for p in products],
+            [desk_code, chair_code, None])
+
+    @with_transaction()
+    def test_intrastat_stats(self):
+        "Test Intrastat statistics are only collected when enabled"
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        with IntrastatStats.collect('test') as stats:
+            self.assertIsNone(stats)
+            self.assertIs(
+                IntrastatStats.stage('search'), IntrastatStats.stage('save'))
+
+        with Transaction().set_context(_intrastat_stats=True), \
+                self.assertLogs(
+                    'trytond.modules.account_stock_eu_es.stock') as logs:
+            with IntrastatStats.collect('test') as stats:
+                with IntrastatStats.collect('nested') as nested:
+                    self.assertIs(nested, stats)
+                with IntrastatStats.stage('search'):
+                    Move.search([])
+                    IntrastatStats.lookup('moves', True)
+                    IntrastatStats.lookup('moves', False)
+                Move.update_intrastat_declaration([])
+                Move.delete_orphan_intrastat_declarations([])
+
+        self.assertEqual(stats.calls['search'], 1)
+        self.assertEqual(stats.calls['delete orphans'], 1)
+        self.assertEqual(stats.counters['moves changed'], 0)
+        self.assertEqual(stats.lookups['moves'], [1, 1])
+        self.assertGreater(stats.stage_queries['search'], 0)
+        self.assertGreaterEqual(stats.queries, stats.stage_queries['search'])
+        log, = logs.output
+        self.assertIn("Intrastat test statistics", log)
+        self.assertIn("stage search", log)
+        self.assertIn("lookup moves: 50.0% hits (1/2)", log)
+
+    def _create_intrastat_company(self, code='BE'):
+        "Create a company of the country code selling to a French customer"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+        Configuration = pool.get('account.configuration')
+        Country = pool.get('country.country')
+        FiscalYear = pool.get('account.fiscalyear')
+        Incoterm = pool.get('incoterm.incoterm')
+        Location = pool.get('stock.location')
+        Organization = pool.get('country.organization')
+        Party = pool.get('party.party')
+        Subdivision = pool.get('country.subdivision')
+        TariffCode = pool.get('customs.tariff.code')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        name, region_name, region_type, intrastat_code = {
+            'BE': ("Belgium", "Walloon Region", 'region', '2'),
+            'ES': ("Spain", "Madrid", 'province', '28'),
+            }[code]
+        country, france, china = Country.create([
+                {'name': name, 'code': code},
+                {'name': "France", 'code': 'FR'},
+                {'name': "China", 'code': 'CN'},
+                ])
+        region, = Subdivision.create([{
+                    'name': region_name,
+                    'country': country.id,
+                    'type': region_type,
+                    'intrastat_code': intrastat_code,
+                    }])
+        europe, = Organization.search([('code', '=', 'EU')])
+        Organization.write([europe], {
+                'members': [('create', [
+                            {'country': country.id},
+                            {'country': france.id},
+                            ])],
+                })
+        company = create_company()
+        company.cancel_invoice_out = True
+        company.save()
+        with set_company(company):
+            address, = company.party.addresses
+            address.country = country
+            address.subdivision = region
+            address.save()
+            warehouse, = Location.search([('code', '=', 'WH')])
+            warehouse.address = address
+            warehouse.save()
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.intrastat_extended = False
+            set_invoice_sequences(fiscalyear)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            category, = Category.create([{
+                        'name': "Category",
+                        'accounting': True,
+                        'account_revenue': revenue.id,
+                        }])
+            unit, = Uom.search([('name', '=', "Unit")])
+            kg, = Uom.search([('name', '=', "Kilogram")])
+            tariff_code, = TariffCode.create([{'code': '9403 10 51'}])
+            template, = Template.create([{
+                        'name': "Desk",
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'account_category': category.id,
+                        'weight': 2,
+                        'weight_uom': kg.id,
+                        'country_of_origin': china.id,
+                        'tariff_codes': [('create', [{
+                                        'tariff_code': tariff_code.id,
+                                        }])],
+                        'products': [('create', [{
+                                        'cost_price': Decimal(10),
+                                        }])],
+                        }])
+            discount, = Template.create([{
+                        'name': "Discount",
+                        'type': 'service',
+                        'default_uom': unit.id,
+                        'account_category': category.id,
+                        'products': [('create', [{}])],
+                        }])
+            configuration = Configuration(1)
+            configuration.intrastat_discount_product = discount.products[0]
+            configuration.save()
+            dap, = Incoterm.search([
+                    ('code', '=', 'DAP'), ('version', '=', '2020')])
+            customer, = Party.create([{
+                        'name': "Customer",
+                        'addresses': [('create', [{'country': france.id}])],
+                        'identifiers': [('create', [{
+                                        'type': 'eu_vat',
+                                        'code': 'FR40303265045',
+                                        }])],
+                        'sale_incoterms': [('create', [{
+                                        'type': 'sale',
+                                        'company': company.id,
+                                        'incoterm': dap.id,
+                                        }])],
+                        }])
+        return company, warehouse, template.products[0], customer, fiscalyear
+
+    def _create_intrastat_moves(
+            self, company, warehouse, product, customer, date, size):
+        "Create size done moves sent to the customer"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        shipment, = ShipmentOut.create([{
+                    'company': company.id,
+                    'customer': customer.id,
+                    'delivery_address': customer.addresses[0].id,
+                    'warehouse': warehouse.id,
+                    'warehouse_storage': warehouse.storage_location.id,
+                    'warehouse_output': warehouse.output_location.id,
+                    'planned_date': date,
+                    }])
+        moves = Move.create([{
+                    'company': company.id,
+                    'product': product.id,
+                    'unit': product.default_uom.id,
+                    'quantity': 1 + i,
+                    'from_location': warehouse.output_location.id,
+                    'to_location': customer.customer_location.id,
+                    'unit_price': Decimal(20 + i),
+                    'currency': company.currency.id,
+                    'planned_date': date,
+                    'effective_date': date,
+                    'shipment': str(shipment),
+                    } for i in range(size)])
+        # The moves have no origin
+        with Transaction().set_user(0):
+            Move.do(moves)
+        return moves
+
+    def _create_intrastat_invoice(self, moves, date):
+        "Create the invoice of the moves with a discount line"
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = moves[0].company
+        invoice = Invoice(
+            company=company, type='out', party=moves[0].shipment.customer,
+            invoice_date=date, currency=company.currency)
+        invoice.on_change_type()
+        invoice.on_change_party()
+        discount = Configuration.get_intrastat_discount_product()
+        lines = [(move.product, move.quantity, move.unit_price, [move])
+            for move in moves]
+        lines.append((discount, 1, Decimal(-len(moves)), []))
+        invoice.lines = [InvoiceLine(
+                type='line', invoice_type='out', company=company,
+                currency=company.currency, product=product,
+                unit=product.default_uom, quantity=quantity,
+                unit_price=unit_price,
+                account=product.account_revenue_used,
+                stock_moves=stock_moves)
+            for product, quantity, unit_price, stock_moves in lines]
+        invoice.save()
+        return invoice
+
+    @with_transaction()
+    def test_intrastat_queries(self):
+        "Test the Intrastat queries do not grow with the number of moves"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('stock.move')
+        Update = pool.get('account.stock.eu.intrastat.update', type='wizard')
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company())
+        sizes = [5, 25]
+        queries = defaultdict(list)
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            for size, period in zip(sizes, fiscalyear.periods):
+                date = period.start_date
+                moves = self._create_intrastat_moves(
+                    company, warehouse, product, customer, date, size)
+                invoice = self._create_intrastat_invoice(moves, date)
+
+                # Only the queries of the Intrastat are counted for the
+                # invoices and each changed move is saved with its own values
+                with count_queries() as stats:
+                    Invoice.post([invoice])
+                if stats.queries is None:
+                    self.skipTest("The queries of the backend are not counted")
+                queries['post'].append(
+                    stats.stage_queries['invoice']
+                    - stats.stage_queries['save'])
+                self.assertEqual(
+                    {m.intrastat_type for m in Move.browse(moves)},
+                    {'dispatch'})
+
+                with count_queries() as stats:
+                    Move.update_intrastat_declaration(moves)
+                queries['update'].append(stats.queries)
+
+                session_id, _, _ = Update.create()
+                update = Update(session_id)
+                update.start.period = period
+                update.start.processing = 'single'
+                update.start.incremental = False
+                update.start.dry_run = False
+                with count_queries() as stats:
+                    update.transition_update()
+                queries['wizard'].append(stats.queries)
+
+                with count_queries() as stats:
+                    Move.diff_intrastat_declaration(moves)
+                queries['diff'].append(stats.queries)
+
+                Move.mark_intrastat_dirty(moves)
+                with count_queries() as stats:
+                    Move.update_intrastat_declaration(moves)
+                queries['update changed'].append(
+                    stats.queries - stats.stage_queries['save'])
+
+                with count_queries() as stats:
+                    Move.reset_intrastat(moves)
+                queries['reset'].append(stats.queries)
+
+                with count_queries() as stats:
+                    Invoice.cancel([invoice])
+                queries['cancel'].append(stats.stage_queries['invoice'])
+
+                # Only the invoices cancelled without move can be reset
+                invoice = self._create_intrastat_invoice(moves, date)
+                Invoice.cancel([invoice])
+                with count_queries() as stats:
+                    Invoice.draft([invoice])
+                queries['draft'].append(
+                    stats.stage_queries['invoice']
+                    - stats.stage_queries['save'])
+                self.assertEqual(
+                    {m.intrastat_type for m in Move.browse(moves)},
+                    {'dispatch'})
+
+        for name, (small, large) in queries.items():
+            with self.subTest(name=name):
+                # A query per move would add one query per extra move
+                self.assertLess(
+                    large - small, (sizes[1] - sizes[0]) // 2,
+                    msg="%s: %s queries for %s moves, %s for %s moves" % (
+                        name, small, sizes[0], large, sizes[1]))
+
+    @with_transaction()
+    def test_intrastat_amount(self):
+        "Test the Intrastat amount is only stored on lines with stock moves"
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company())
+        date = fiscalyear.periods[0].start_date
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            moves = self._create_intrastat_moves(
+                company, warehouse, product, customer, date, 1)
+            invoice = self._create_intrastat_invoice(moves, date)
+            configuration = Configuration(1)
+            configuration.intrastat_discount_product = None
+            configuration.save()
+            Invoice.post([invoice])
+            line, service = invoice.lines
+            self.assertIsNotNone(line.intrastat_amount)
+            self.assertIsNone(service.intrastat_amount)
+
+    @with_transaction()
+    def test_intrastat_post_dirty(self):
+        "Test only the moves updated by the queue are flagged when posting"
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('stock.move')
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company())
+        date = fiscalyear.periods[0].start_date
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            moves = self._create_intrastat_moves(
+                company, warehouse, product, customer, date, 2)
+            Move.update_intrastat_declaration(moves)
+            invoice, deferred = [
+                self._create_intrastat_invoice([m], date) for m in moves]
+            configuration = Configuration(1)
+            configuration.intrastat_discount_product = None
+            configuration.save()
+
+            # Without discount the invoice does not change the value of the
+            # move
+            with count_queries() as stats:
+                Invoice.post([invoice])
+            if stats.queries is None:
+                self.skipTest("The queries of the backend are not counted")
+            self.assertEqual(stats.counters.get('moves saved', 0), 0)
+            self.assertFalse(Move(moves[0].id).intrastat_dirty)
+
+            configuration.intrastat_update_delay = dt.timedelta(minutes=5)
+            configuration.save()
+            Invoice.post([deferred])
+            self.assertTrue(Move(moves[1].id).intrastat_dirty)
+
+    @with_transaction()
+    def test_intrastat_dirty_cost_price(self):
+        "Test only the moves valued at the cost price are flagged"
+        pool = Pool()
+        Declaration = pool.get('account.stock.eu.intrastat.declaration')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        table = Move.__table__()
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company())
+        date = fiscalyear.periods[0].start_date
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            priced, free = self._create_intrastat_moves(
+                company, warehouse, product, customer, date, 2)
+            cursor.execute(*table.update(
+                    [table.unit_price, table.intrastat_dirty], [0, False],
+                    where=table.id == free.id))
+            Move._clear_transaction_cache([free.id])
+
+            product.cost_price = Decimal(15)
+            product.save()
+            self.assertEqual(
+                [m.intrastat_dirty for m in Move.browse([priced, free])],
+                [False, True])
+
+            # The moves of closed declarations are flagged like by the other
+            # inputs
+            Declaration.close([free.intrastat_declaration])
+
+            def clear_flag():
+                cursor.execute(*table.update(
+                        [table.intrastat_dirty], [False],
+                        where=table.id == free.id))
+                Move._clear_transaction_cache([free.id])
+
+            clear_flag()
+            product.cost_price = Decimal(12)
+            product.save()
+            self.assertTrue(Move(free.id).intrastat_dirty)
+
+            clear_flag()
+            link, = product.template.tariff_codes
+            link.sequence = 10
+            link.save()
+            self.assertTrue(Move(free.id).intrastat_dirty)
+
+    @with_transaction()
+    def test_intrastat_update_queue(self):
+        "Test the queued update of the Intrastat"
+        pool = Pool()
+        Address = pool.get('party.address')
+        Checkpoint = pool.get('account.stock.eu.intrastat.update.checkpoint')
+        Country = pool.get('country.country')
+        Declaration = pool.get('account.stock.eu.intrastat.declaration')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Task = pool.get('account.stock.eu.intrastat.update.task')
+        Update = pool.get('account.stock.eu.intrastat.update', type='wizard')
+
+        def update_queue(period):
+            session_id, _, _ = Update.create()
+            update = Update(session_id)
+            update.start.period = period
+            update.start.processing = 'queue'
+            update.start.chunk_size = 2
+            update.start.restart = False
+            update.start.incremental = False
+            update.start.dry_run = False
+            update.transition_update()
+            checkpoint, = Checkpoint.search([])
+            return checkpoint
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company())
+        france, = Country.search([('code', '=', 'FR')])
+        germany, = Country.create([{'name': "Germany", 'code': 'DE'}])
+        period, next_period = fiscalyear.periods[:2]
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            # A warehouse without moves of the company
+            address, = Address.create([{
+                        'party': company.party.id,
+                        'country': germany.id,
+                        }])
+            Location.copy([warehouse], default={
+                    'code': None,
+                    'address': address.id,
+                    })
+            moves = self._create_intrastat_moves(
+                company, warehouse, product, customer, period.start_date, 3)
+            declaration, = Declaration.search([])
+
+            checkpoint = update_queue(period)
+            self.assertEqual(checkpoint.declarations, ())
+            first, second = checkpoint.tasks
+            Task.process([first], [m.id for m in moves[:2]])
+            Checkpoint.finish([checkpoint])
+            self.assertEqual(Checkpoint.search([]), [checkpoint])
+            # Each task records the declarations its moves leave
+            self.assertEqual(checkpoint.declarations, (declaration,))
+            Task.process([second], [m.id for m in moves[2:]])
+            Checkpoint.finish([checkpoint])
+            self.assertEqual(Checkpoint.search([]), [])
+            self.assertEqual(
+                {m.intrastat_declaration for m in Move.browse(moves)},
+                {declaration})
+
+            # The declarations are created before the tasks for the
+            # warehouses of the moves and only those left empty by the
+            # update are deleted
+            month = next_period.start_date.replace(day=1)
+            moves = self._create_intrastat_moves(
+                company, warehouse, product, customer,
+                next_period.start_date, 1)
+            Move.reset_intrastat(moves)
+            Move.write(moves, {'intrastat_cancelled': False})
+            Declaration.delete(Declaration.search([('month', '=', month)]))
+            other, = Declaration.create([{
+                        'company': company.id,
+                        'country': france.id,
+                        'month': month,
+                        }])
+            checkpoint = update_queue(next_period)
+            created, = checkpoint.declarations
+            self.assertEqual(created.month, month)
+            self.assertEqual(created.country, warehouse.address.country)
+            task, = checkpoint.tasks
+            Task.process([task], [m.id for m in moves])
+            Checkpoint.finish([checkpoint])
+            self.assertEqual(
+                set(Declaration.search([('month', '=', month)])),
+                {created, other})
+
+    @with_transaction()
+    def test_intrastat_update_checkpoint_resume(self):
+        "Test the chunked update resumes only a checkpoint of the same mode"
+        pool = Pool()
+        Checkpoint = pool.get('account.stock.eu.intrastat.update.checkpoint')
+
+        company, _, _, _, fiscalyear = self._create_intrastat_company()
+        period = fiscalyear.periods[0]
+        with set_company(company):
+            checkpoint = Checkpoint.get(company.id, period.id, False)
+            self.assertEqual(
+                Checkpoint.get(company.id, period.id, False), checkpoint)
+
+            incremental = Checkpoint.get(company.id, period.id, True)
+            self.assertNotEqual(incremental, checkpoint)
+            self.assertTrue(incremental.incremental)
+
+            restarted = Checkpoint.get(
+                company.id, period.id, True, restart=True)
+            self.assertNotEqual(restarted, incremental)
+            self.assertEqual(Checkpoint.search([]), [restarted])
+
+    @with_transaction()
+    def test_intrastat_export_aeat(self):
+        "Test the export of a Spanish declaration in the AEAT layout"
+        pool = Pool()
+        Declaration = pool.get('account.stock.eu.intrastat.declaration')
+        Export = pool.get(
+            'account.stock.eu.intrastat.declaration.export', type='wizard')
+        Invoice = pool.get('account.invoice')
+        IntrastatTransaction = pool.get(
+            'account.stock.eu.intrastat.transaction')
+        Move = pool.get('stock.move')
+
+        company, warehouse, product, customer, fiscalyear = (
+            self._create_intrastat_company('ES'))
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            date = fiscalyear.periods[0].start_date
+            moves = self._create_intrastat_moves(
+                company, warehouse, product, customer, date, 2)
+            invoice = self._create_intrastat_invoice(moves, date)
+            Invoice.post([invoice])
+            declaration, = Declaration.search([])
+            transaction = moves[0].intrastat_transaction
+
+            def export():
+                session_id, _, _ = Export.create()
+                with Transaction().set_context(
+                        active_model=Declaration.__name__,
+                        active_id=declaration.id,
+                        active_ids=[declaration.id]):
+                    result = Export.execute(session_id, {}, 'generate')
+                result = result['view']['defaults']
+                self.assertEqual(
+                    result['filename'], f'{declaration.rec_name}.zip')
+                with ZipFile(BytesIO(result['file'])) as zip:
+                    self.assertEqual(zip.namelist(), ['dispatch-0.csv'])
+                    content = zip.read('dispatch-0.csv').decode()
+                Export.delete(session_id)
+                return content.splitlines()
+
+            self.assertEqual(export(), [
+                    f'FR;28;;{transaction.code};;;94031051;CN;1;6,000;;'
+                    '60,00;60,00;FR40303265045',
+                    ])
+
+            # The transactions with a view to processing are temporary
+            processing = IntrastatTransaction.get('41')
+            Move.write([moves[1]], {'intrastat_transaction': processing.id})
+            self.assertEqual(export(), [
+                    f'FR;28;;{transaction.code};;;94031051;CN;1;2,000;;'
+                    '19,33;19,33;FR40303265045',
+                    'FR;28;;41;;;94031051;CN;2;4,000;;'
+                    '40,67;40,67;FR40303265045',
+                    ])
+
 
 del ModuleTestCase
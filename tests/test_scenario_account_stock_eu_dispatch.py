@@ -178,6 +178,7 @@ class Test(unittest.TestCase):
         self.assertEqual(move.intrastat_country_of_origin.code, 'CN')
         move.intrastat_vat
         self.assertEqual(move.intrastat_declaration.month, today.replace(day=1))
+        self.assertEqual(shipment.total_intrastat_value, Decimal('1800.00'))
 
         # Send products to US
         shipment = ShipmentOut()
@@ -199,6 +200,17 @@ class Test(unittest.TestCase):
         move.intrastat_type
         move, = shipment.outgoing_moves
         move.intrastat_type
+        self.assertEqual(shipment.total_intrastat_value, Decimal('0.00'))
+
+        # Search and sort shipments by their Intrastat value
+        shipments = ShipmentOut.find([('total_intrastat_value', '>', 0)])
+        self.assertEqual(
+            [s.total_intrastat_value for s in shipments],
+            [Decimal('1800.00')])
+        shipments = ShipmentOut.find(
+            [], order=[('total_intrastat_value', 'DESC')])
+        self.assertEqual(
+            shipments[0].total_intrastat_value, Decimal('1800.00'))
 
         # Send returned products to France
         shipment = ShipmentInReturn()
@@ -269,7 +281,7 @@ class Test(unittest.TestCase):
         self.assertEqual(zip.namelist(), ['dispatch-0.csv'])
         self.assertEqual(
             zip.open('dispatch-0.csv').read(),
-            b'FR;2;;11;;;9403 10 51;CN;;60.0;20.0;1800.00;1800.00;FR40303265045\r\nFR;2;;21;;;9403 10 51;CN;;15.0;5.0;750.00;750.00;FR40303265045\r\n'
+            b'FR;2;;11;;;94031051;CN;1;60,000;20,000;1800,00;1800,00;FR40303265045\r\nFR;2;;21;;;94031051;CN;1;15,000;5,000;750,00;750,00;FR40303265045\r\n'
         )
 
         # Export declaration as fallback
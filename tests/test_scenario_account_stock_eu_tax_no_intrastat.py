@@ -261,3 +261,116 @@ class Test(unittest.TestCase):
         self.assertEqual(intrastat_move.intrastat_transaction.code, '11')
         self.assertEqual(intrastat_move.intrastat_additional_unit, 5.0)
         self.assertEqual(intrastat_move.intrastat_country_of_origin.code, 'CN')
+
+        # Update intrastat by chunks
+        shipment.reload()
+        write_dates = [m.write_date for m in shipment.outgoing_moves]
+        update = Wizard('account.stock.eu.intrastat.update')
+        update.form.period, = Period.find([('start_date', '<=', today),
+                                             ('end_date', '>=', today)])
+        update.form.processing = 'chunked'
+        update.form.chunk_size = 1
+        update.execute('update')
+
+        # The moves already up to date are not written again
+        shipment.reload()
+        move, intrastat_move = shipment.outgoing_moves
+        self.assertEqual(
+            [m.write_date for m in shipment.outgoing_moves], write_dates)
+        self.assertEqual(move.intrastat_type, None)
+        self.assertEqual(move.intrastat_declaration, None)
+        self.assertEqual(intrastat_move.intrastat_type, 'dispatch')
+        self.assertEqual(intrastat_move.intrastat_value, Decimal('300.00'))
+        self.assertEqual(intrastat_move.intrastat_additional_unit, 5.0)
+        self.assertEqual(intrastat_move.intrastat_declaration.month,
+            today.replace(day=1))
+
+        # Update intrastat with parallel tasks
+        update = Wizard('account.stock.eu.intrastat.update')
+        update.form.period, = Period.find([('start_date', '<=', today),
+                                             ('end_date', '>=', today)])
+        update.form.processing = 'queue'
+        update.form.chunk_size = 1
+        update.execute('update')
+
+        move, intrastat_move = shipment.outgoing_moves
+        self.assertEqual(move.intrastat_type, None)
+        self.assertEqual(move.intrastat_declaration, None)
+        self.assertEqual(intrastat_move.intrastat_type, 'dispatch')
+        self.assertEqual(intrastat_move.intrastat_value, Decimal('300.00'))
+        self.assertEqual(intrastat_move.intrastat_additional_unit, 5.0)
+        self.assertEqual(intrastat_move.intrastat_declaration.month,
+            today.replace(day=1))
+
+        # Changing the exempt taxes flags the moves for the incremental update
+        stock_config = StockConfig(1)
+        stock_config.intrastat_exempt_taxes.pop(
+            stock_config.intrastat_exempt_taxes.index(Tax(tax21.id)))
+        stock_config.save()
+        shipment.reload()
+        move, intrastat_move = shipment.outgoing_moves
+        self.assertEqual(move.intrastat_dirty, True)
+        self.assertEqual(intrastat_move.intrastat_dirty, False)
+
+        update = Wizard('account.stock.eu.intrastat.update')
+        update.form.period, = Period.find([('start_date', '<=', today),
+                                             ('end_date', '>=', today)])
+        update.form.incremental = True
+        update.execute('update')
+
+        shipment.reload()
+        move, intrastat_move = shipment.outgoing_moves
+        self.assertEqual(move.intrastat_dirty, False)
+        self.assertEqual(move.intrastat_cancelled, True)
+        self.assertEqual(move.intrastat_declaration, None)
+        self.assertEqual(intrastat_move.intrastat_type, 'dispatch')
+
+        # Post the invoice with an Intrastat discount line
+        discount_template = ProductTemplate(name="Discount")
+        discount_template.default_uom = unit
+        discount_template.type = 'service'
+        discount_template.account_category = account_category
+        discount_template.save()
+        discount_product, = discount_template.products
+        AccountConfig = Model.get('account.configuration')
+        account_config = AccountConfig(1)
+        account_config.intrastat_discount_product = discount_product
+        account_config.intrastat_update_delay = dt.timedelta(0)
+        account_config.save()
+
+        sale.reload()
+        invoice, = sale.invoices
+        discount_line = invoice.lines.new()
+        discount_line.product = discount_product
+        discount_line.quantity = 1
+        discount_line.unit_price = Decimal('-30')
+        invoice.click('post')
+        lines = {l.product: l for l in invoice.lines}
+        self.assertEqual(lines[product].intrastat_amount, Decimal('380'))
+        self.assertEqual(
+            lines[product_intrastat].intrastat_amount, Decimal('290'))
+        self.assertEqual(lines[discount_product].intrastat_amount, None)
+
+        # The moves are updated by the queue task
+        shipment.reload()
+        move, intrastat_move = shipment.outgoing_moves
+        self.assertEqual(intrastat_move.intrastat_dirty, False)
+        self.assertEqual(intrastat_move.intrastat_value, Decimal('290.00'))
+
+        # Report the changes of the update without writing them
+        stock_config = StockConfig(1)
+        stock_config.intrastat_exempt_taxes.append(Tax(tax_intrastat.id))
+        stock_config.save()
+        update = Wizard('account.stock.eu.intrastat.update')
+        update.form.period, = Period.find([('start_date', '<=', today),
+                                             ('end_date', '>=', today)])
+        update.form.dry_run = True
+        update.execute('update')
+        self.assertEqual(
+            [m.id for m in update.form.dropped_moves], [intrastat_move.id])
+        self.assertIn('-290.00', update.form.declaration_deltas)
+        self.assertIn('Intrastat Type: 1', update.form.field_changes)
+        update.execute('end')
+        intrastat_move.reload()
+        self.assertEqual(intrastat_move.intrastat_type, 'dispatch')
+        self.assertEqual(intrastat_move.intrastat_value, Decimal('290.00'))